@@ -0,0 +1,186 @@
+import os
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+import numpy as np
+from numpy.typing import NDArray
+from sklearn.cluster import MiniBatchKMeans
+
+from data_io.readwrite_files import read_json, write_json
+from handwritten_ocr.embedding_store import EmbeddingStore
+from handwritten_ocr.trocr_inference import EmbeddedData
+from misc_utils.cached_data import ContinuedCachedData
+from misc_utils.dataclass_utils import UNDEFINED, _UNDEFINED
+from misc_utils.prefix_suffix import PrefixSuffix
+
+
+def normalize_rows(x: NDArray) -> NDArray:
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+@dataclass
+class IVFIndex:
+    # inverted-file index (cosine similarity) over the rows of an EmbeddingStore:
+    # k-means centroids partition the rows into lists, a query only scans the rows
+    # of its num_probe closest lists; vectors are not copied, only row-assignments
+    directory: str
+    store: EmbeddingStore
+    num_lists: int = 256
+    num_probe: int = 8
+    centroids: Optional[NDArray] = field(init=False, default=None, repr=False)
+    assignments: Optional[NDArray] = field(init=False, default=None, repr=False)
+    _lists: Optional[list[NDArray]] = field(init=False, default=None, repr=False)
+    trained_on_rows: int = field(init=False, default=0, repr=False)
+
+    def __post_init__(self):
+        if os.path.isfile(self.centroids_npy):
+            self.centroids = np.load(self.centroids_npy)
+            self.num_lists = len(self.centroids)
+            if os.path.isfile(self.train_json):
+                self.trained_on_rows = read_json(self.train_json)["trained_on_rows"]
+        self.assignments = (
+            np.fromfile(self.assignments_file, dtype=np.int32)
+            if os.path.isfile(self.assignments_file)
+            else np.zeros((0,), dtype=np.int32)
+        )
+
+    @property
+    def centroids_npy(self) -> str:
+        return f"{self.directory}/centroids.npy"
+
+    @property
+    def assignments_file(self) -> str:
+        return f"{self.directory}/assignments.int32"
+
+    @property
+    def train_json(self) -> str:
+        return f"{self.directory}/train.json"
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def __len__(self) -> int:
+        return len(self.assignments)
+
+    def train(self, sample: NDArray):
+        # (re)training invalidates all row-assignments
+        kmeans = MiniBatchKMeans(
+            n_clusters=min(self.num_lists, len(sample)), random_state=42
+        ).fit(normalize_rows(sample))
+        self.centroids = normalize_rows(kmeans.cluster_centers_)
+        self.num_lists = len(self.centroids)
+        self.trained_on_rows = len(self.store)
+        os.makedirs(self.directory, exist_ok=True)
+        np.save(self.centroids_npy, self.centroids)
+        write_json(self.train_json, {"trained_on_rows": self.trained_on_rows})
+        if os.path.isfile(self.assignments_file):
+            os.remove(self.assignments_file)
+        self.assignments = np.zeros((0,), dtype=np.int32)
+        self._lists = None
+
+    def add_new_rows(self, batch_size: int = 100_000) -> int:
+        # incremental: assigns only the store-rows that were appended since last time
+        assert self.is_trained
+        start = len(self)
+        stop = len(self.store)
+        with open(self.assignments_file, "ab") as f:
+            for k in range(start, stop, batch_size):
+                vectors = normalize_rows(self.store[k : min(k + batch_size, stop)])
+                lists = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+                f.write(lists.tobytes())
+                self.assignments = np.concatenate([self.assignments, lists])
+        self._lists = None
+        return stop - start
+
+    @property
+    def lists(self) -> list[NDArray]:
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            counts = np.bincount(self.assignments, minlength=self.num_lists)
+            self._lists = np.split(order, np.cumsum(counts)[:-1])
+        return self._lists
+
+    def search(
+        self, queries: NDArray, k: int = 10, num_probe: Optional[int] = None
+    ) -> tuple[NDArray, NDArray]:
+        # returns rows and cosine-similarities of shape (num_queries, k),
+        # padded with -1 / -inf if the probed lists hold less than k rows
+        num_probe = min(
+            self.num_probe if num_probe is None else num_probe, self.num_lists
+        )
+        queries = normalize_rows(np.atleast_2d(queries))
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :num_probe]
+
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, (query, probe) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([self.lists[p] for p in probe])
+            if len(candidates) == 0:
+                continue
+            candidates.sort()  # sequential reads from the memmap
+            candidate_sims = normalize_rows(self.store[candidates]) @ query
+            top = np.argsort(-candidate_sims)[:k]
+            rows[q, : len(top)] = candidates[top]
+            sims[q, : len(top)] = candidate_sims[top]
+        return rows, sims
+
+
+@dataclass
+class EmbeddingsIVFIndex(ContinuedCachedData):
+    # each (continued) build assigns the rows that were added to the store since
+    name: Union[_UNDEFINED, str] = UNDEFINED
+    embedded_data: Union[_UNDEFINED, EmbeddedData] = UNDEFINED
+    num_lists: int = 256
+    num_train_samples: int = 100_000
+    num_probe: int = field(default=8, repr=False)
+    min_rows_per_list: int = field(default=39, repr=False)
+    retrain_growth: float = field(default=4.0, repr=False)
+
+    cache_base: PrefixSuffix = field(
+        default_factory=lambda: PrefixSuffix("cache_root", "ann_indexes")
+    )
+
+    @property
+    def index(self) -> IVFIndex:
+        if not hasattr(self, "_index"):
+            self._index = IVFIndex(
+                directory=self.prefix_cache_dir("ivf"),
+                store=self.embedded_data.store,
+                num_lists=self.num_lists,
+                num_probe=self.num_probe,
+            )
+        return self._index
+
+    def continued_build_cache(self) -> None:
+        store = self.embedded_data.store
+        # k-means needs enough rows per list, centroids fitted on a small first
+        # build (e.g. one debug-pdf) are replaced once the store grew retrain_growth
+        if len(store) < self.min_rows_per_list * self.num_lists:
+            print(f"only {len(store)} rows, search falls back to exact scan")
+            return
+        grown = len(store) >= self.retrain_growth * self.index.trained_on_rows
+        if not self.index.is_trained or grown:
+            self.retrain()
+        num_added = self.index.add_new_rows()
+        print(f"added {num_added} rows, index holds {len(self.index)} rows")
+
+    def retrain(self):
+        store = self.embedded_data.store
+        sample_size = min(self.num_train_samples, len(store))
+        sample_rows = np.sort(
+            np.random.default_rng(42).choice(len(store), sample_size, replace=False)
+        )
+        self.index.num_lists = self.num_lists
+        self.index.train(store[sample_rows])
+        self.index.add_new_rows()
+
+    def search(self, queries: NDArray, k: int = 10) -> tuple[NDArray, NDArray]:
+        if self.index.is_trained:
+            return self.index.search(queries, k)
+        # exact scan, the store is small as long as there is no trained index
+        store = self.embedded_data.store
+        sims = normalize_rows(np.atleast_2d(queries)) @ normalize_rows(store[:]).T
+        rows = np.argsort(-sims, axis=1)[:, :k]
+        return rows, np.take_along_axis(sims, rows, axis=1)
@@ -1,51 +1,129 @@
 import os
-from dataclasses import dataclass
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Union
+from time import time
+from typing import Optional, Union
 
 import ocrmypdf
+from tqdm import tqdm
 
-from misc_utils.cached_data import CachedData
+from data_io.readwrite_files import write_json, write_jsonl
+from handwritten_ocr.word_boxes import extract_word_boxes
+from misc_utils.cached_data import ContinuedCachedData
 from misc_utils.dataclass_utils import UNDEFINED, _UNDEFINED
-from misc_utils.processing_utils import exec_command
+
+
+def ocr_pdf(
+    pdf_file: str,
+    output_file: str,
+    lang: str,
+    jobs: int,
+    sidecar_file: Optional[str] = None,
+    word_boxes_file: Optional[str] = None,
+) -> tuple[str, float, Optional[str]]:
+    start = time()
+    try:
+        # written under a temporary name, so an interrupted run never leaves a
+        # half-written output that would be skipped when resuming
+        tmp_file = f"{output_file}.part"
+        ocrmypdf.ocr(
+            input_file=pdf_file,
+            output_file=tmp_file,
+            language=lang,
+            jobs=jobs,
+            use_threads=True,  # parallelism comes from the outer process-pool
+            progress_bar=False,
+            sidecar=sidecar_file,
+        )
+        if word_boxes_file is not None:
+            write_json(word_boxes_file, extract_word_boxes(tmp_file))
+        os.replace(tmp_file, output_file)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return pdf_file, time() - start, error
 
 
 @dataclass
-class OCRMyPDFsFolder(CachedData):
+class OCRMyPDFsFolder(ContinuedCachedData):
+    # https://ocrmypdf.readthedocs.io/en/latest/batch.html
+    # one pdf per worker-process, each with jobs_per_file ocrmypdf-jobs, so that
+    # num_workers * jobs_per_file roughly matches the number of cores
     folder: Union[_UNDEFINED, str] = UNDEFINED
     lang: Union[_UNDEFINED, str] = UNDEFINED
     name: Union[_UNDEFINED, str] = UNDEFINED
+    jobs_per_file: int = field(default=1, repr=False)
+    num_workers: Optional[int] = field(default=None, repr=False)
+    # <stem>_ocr.txt: plain text per page, <stem>_words.json: per-page word-boxes
+    write_sidecar: bool = False
+    write_word_boxes: bool = False
+
+    @property
+    def output_dir(self):
+        return self.prefix_cache_dir("ocred_pdfs")
+
+    @property
+    def timings_jsonl(self):
+        return self.prefix_cache_dir("timings.jsonl")
+
+    @property
+    def failures_jsonl(self):
+        return self.prefix_cache_dir("failures.jsonl")
+
+    def continued_build_cache(self) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        pdf_files = [
+            p for p in Path(self.folder).rglob("*.*") if p.suffix.lower() == ".pdf"
+        ]
+        todo = [
+            (str(p), f"{self.output_dir}/{p.stem}")
+            for p in pdf_files
+            if not os.path.isfile(f"{self.output_dir}/{p.stem}_ocr.pdf")
+        ]
+        print(f"already got: {len(pdf_files) - len(todo)}, {len(todo)} still TODO")
 
-    def _build_cache(self):
-        for pdf_file in Path(self.folder).rglob("*.*"):
-            print(f"{pdf_file}")
-            ouput_dir = self.prefix_cache_dir("ocred_pdfs")
-            os.makedirs(ouput_dir)
-            ocrmypdf.ocr(
-                input_file=pdf_file,
-                output_file=f"{ouput_dir}/{pdf_file.stem}_ocr.pdf",
-                language="spa",
-            )
-            # _,e=exec_command(f"ocrmypdf -l {self.lang} -r {pdf_file} {ouput_dir}/{pdf_file.stem}_ocr.pdf")
-            # if len(e)>0:
-            #     print(f"failed with: {e}")
-            break
+        num_workers = (
+            self.num_workers
+            if self.num_workers is not None
+            else max(1, os.cpu_count() // self.jobs_per_file)
+        )
+        num_failed = 0
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(
+                    ocr_pdf,
+                    pdf,
+                    f"{out}_ocr.pdf",
+                    self.lang,
+                    self.jobs_per_file,
+                    f"{out}_ocr.txt" if self.write_sidecar else None,
+                    f"{out}_words.json" if self.write_word_boxes else None,
+                )
+                for pdf, out in todo
+            ]
+            pbar = tqdm(as_completed(futures), total=len(futures), desc="ocrmypdf")
+            for f in pbar:
+                pdf_file, duration, error = f.result()
+                datum = {"pdf_file": pdf_file, "duration": duration}
+                write_jsonl(self.timings_jsonl, [datum], mode="ab")
+                if error is not None:
+                    num_failed += 1
+                    print(f"{pdf_file} failed!")
+                    write_jsonl(
+                        self.failures_jsonl, [datum | {"error": error}], mode="ab"
+                    )
+                pbar.set_postfix(failed=num_failed)
 
 
 if __name__ == "__main__":
-    # https://ocrmypdf.readthedocs.io/en/latest/batch.html -> TODO!
-    # cache_base = os.environ['DATA_PATH']
-    # OCRMyPDFsFolder(
-    #     name="esc_cong_2018",
-    #     lang="spa",
-    #     folder=f"{cache_base}/WgetPdfs-esc_cong_2018-64ef3d6edcc9a7961dab1c80f2d9e07569e82362/pdfs",
-    #     cache_base=cache_base,
-    # ).build()
-    base_path = "handwritten_ocr"
-
-    pdf_file = f"handwritten_ocr/data/e14_cong_2018__e14_divulgacion_01_001_001_CAM_E14_CAM_X_01_001_001_XX_01_005_X_XXX.pdf"
-    ocrmypdf.ocr(
-        input_file=pdf_file,
-        output_file=f"handwritten_ocr/{Path(pdf_file).stem}_ocr.pdf",
-        language="spa",
-    )
+    cache_base = os.environ["DATA_PATH"]
+    OCRMyPDFsFolder(
+        name="esc_cong_2018",
+        lang="spa",
+        folder=f"{cache_base}/WgetPdfs-esc_cong_2018-64ef3d6edcc9a7961dab1c80f2d9e07569e82362/pdfs",
+        cache_base=cache_base,
+        write_sidecar=True,
+        write_word_boxes=True,
+    ).build()
@@ -0,0 +1,50 @@
+import sys
+from pathlib import Path
+from time import time
+
+import numpy as np
+
+sys.path.append(".")
+
+from handwritten_ocr.trocr_inference import BACKENDS, OCRInferencer
+from misc_utils.utils import build_markdown_table_from_dicts
+
+
+def mean_cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return float(np.mean(np.sum(a * b, axis=1)))
+
+
+if __name__ == "__main__":
+    # accuracy (agreement with the fp32-torch backend) vs. speed on the sample images
+    model_name = "microsoft/trocr-base-handwritten"
+    files = sorted(str(p) for p in Path("handwritten_ocr/images").glob("*.png"))
+    images = files * 8  # no inference-cache, so repetitions are computed again
+
+    reference_texts, reference_embeddings = None, None
+    rows = []
+    for backend in BACKENDS:
+        inferencer = OCRInferencer(model_name=model_name, backend=backend).build()
+        inferencer.ocr_batch(files)  # warm-up
+
+        start = time()
+        texts = inferencer.ocr_batch(images)
+        ocr_duration = time() - start
+        start = time()
+        embeddings = inferencer.embedd_batch(images).numpy()
+        embedd_duration = time() - start
+
+        if reference_texts is None:
+            reference_texts, reference_embeddings = texts, embeddings
+        rows.append(
+            {
+                "backend": backend,
+                "ocr [sec/image]": f"{ocr_duration / len(images):.3f}",
+                "embedd [sec/image]": f"{embedd_duration / len(images):.3f}",
+                "same text as torch": f"{np.mean([t == r for t, r in zip(texts, reference_texts)]):.2f}",
+                "embedding cosine to torch": f"{mean_cosine_similarity(embeddings, reference_embeddings):.4f}",
+                "example": texts[0],
+            }
+        )
+    print(build_markdown_table_from_dicts(rows))
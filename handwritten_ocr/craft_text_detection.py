@@ -1,9 +1,13 @@
 # import Craft class
 import os
 from dataclasses import dataclass, field
-from typing import Union, Iterable, Iterator
+from typing import ClassVar, Optional, Union, Iterable, Iterator
 
+import numpy as np
 from craft_text_detector import Craft
+from craft_text_detector.file_utils import rectify_poly
+from craft_text_detector.image_utils import read_image
+from numpy.typing import NDArray
 from tqdm import tqdm
 
 # set image path and export folder directory
@@ -12,12 +16,68 @@ from misc_utils.cached_data_specific import CachedDataclasses
 from misc_utils.dataclass_utils import UNDEFINED, _UNDEFINED
 from misc_utils.prefix_suffix import PrefixSuffix
 
+CRAFT_KWARGS = {
+    "text_threshold": 0.25,
+    "crop_type": "poly",
+    "low_text": 0.3,
+    "long_size": 2000,
+    "cuda": False,
+}
+
+
+class CraftPool:
+    # one lazily loaded Craft per worker-process and config, shared by all documents
+    # that process handles; models stay resident until shutdown is called
+    _crafts: ClassVar[dict[tuple, Craft]] = {}
+
+    @classmethod
+    def get(cls, output_dir: Optional[str] = None, **craft_kwargs) -> Craft:
+        key = (os.getpid(), tuple(sorted(craft_kwargs.items())))
+        if key not in cls._crafts:
+            cls._crafts[key] = Craft(**craft_kwargs)
+        craft = cls._crafts[key]
+        craft.output_dir = output_dir
+        return craft
+
+    @classmethod
+    def shutdown(cls):
+        for (pid, _), craft in list(cls._crafts.items()):
+            if pid == os.getpid():
+                craft.unload_craftnet_model()
+                craft.unload_refinenet_model()
+        cls._crafts.clear()
+
 
 @dataclass
 class CroppedImage:
     image_file: PrefixSuffix
-    cropped_image_file: PrefixSuffix
+    cropped_image_file: Optional[PrefixSuffix]  # None if crop was not persisted
     box: list[list[float]]
+    # region that is cut out, with crop_type="poly" craft exports its crops from
+    # these (possibly more than 4-point) polygons and not from the boxes
+    poly: list[list[float]]
+
+
+def crop_boxes(page: NDArray, polys: Iterable[NDArray]) -> list[NDArray]:
+    # same affine rectification craft uses when it exports crops to files
+    return [rectify_poly(page, np.asarray(p)) for p in polys]
+
+
+def iter_crop_arrays(
+    cropped_images: Iterable[CroppedImage],
+) -> Iterator[tuple[CroppedImage, NDArray]]:
+    # not persisted crops are cut out of their page again, consecutive crops of
+    # the same page share one decoded page-array
+    page_file, page = None, None
+    for im in cropped_images:
+        if im.cropped_image_file is not None:
+            yield im, read_image(str(im.cropped_image_file))
+            continue
+        if str(im.image_file) != page_file:
+            page_file = str(im.image_file)
+            page = read_image(page_file)
+        (crop,) = crop_boxes(page, [im.poly])
+        yield im, crop
 
 
 @dataclass
@@ -27,30 +87,37 @@ class CraftCroppedImages(CachedDataclasses[CroppedImage]):
     cache_base: PrefixSuffix = field(
         default_factory=lambda: PrefixSuffix("cache_root", "cropped_images")
     )
+    keep_model_resident: bool = field(default=True, repr=False)
+    persist_crops: bool = False  # crop-files are only needed for debugging
 
     @property
     def output_dir(self):
         return self.prefix_cache_dir("data")
 
     def generate_dataclasses_to_cache(self) -> Iterator[CroppedImage]:
-        os.makedirs(self.output_dir, exist_ok=True)
-
-        craft = Craft(
-            output_dir=self.output_dir,
-            text_threshold=0.25,
-            crop_type="poly",
-            low_text=0.3,
-            long_size=2000,
-            cuda=False,
-        )
+        output_dir = self.output_dir if self.persist_crops else None
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+
+        if self.keep_model_resident:
+            craft = CraftPool.get(output_dir=output_dir, **CRAFT_KWARGS)
+        else:
+            craft = Craft(output_dir=output_dir, **CRAFT_KWARGS)
         for f in tqdm(self.image_files, desc="craft-detecting"):
             r = craft.detect_text(str(f))
-            for crop_file, b in zip(r["text_crop_paths"], r["boxes"]):
+            crop_files = r["text_crop_paths"] or [None] * len(r["boxes"])
+            for crop_file, b, p in zip(crop_files, r["boxes"], r["polys"]):
                 yield CroppedImage(
                     image_file=self.cache_dir.from_str_same_prefix(str(f)),
-                    cropped_image_file=self.cache_dir.from_str_same_prefix(crop_file),
+                    cropped_image_file=(
+                        None
+                        if crop_file is None
+                        else self.cache_dir.from_str_same_prefix(crop_file)
+                    ),
                     box=b.tolist(),
+                    poly=np.asarray(p).tolist(),
                 )
 
-        craft.unload_craftnet_model()
-        craft.unload_refinenet_model()
+        if not self.keep_model_resident:
+            craft.unload_craftnet_model()
+            craft.unload_refinenet_model()
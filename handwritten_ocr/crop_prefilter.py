@@ -0,0 +1,106 @@
+import os
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import numpy as np
+from numpy.typing import NDArray
+from PIL import Image
+
+from data_io.readwrite_files import read_json, write_json
+from handwritten_ocr.inference_cache import content_hash
+
+KEEP, BLANK, PRINTED, DUPLICATE = "keep", "blank", "printed", "duplicate"
+
+
+def to_gray(crop: NDArray) -> NDArray:
+    return crop.mean(axis=2) if crop.ndim == 3 else crop
+
+
+def ink_density(gray: NDArray, border: float = 0.1) -> float:
+    # fraction of dark pixels, the outer border is ignored so that the printed
+    # frame of an empty cell does not count as ink
+    h, w = gray.shape
+    dy, dx = int(h * border), int(w * border)
+    inner = gray[dy : h - dy, dx : w - dx]
+    return float((inner < 128).mean()) if inner.size > 0 else 0.0
+
+
+def dhash(gray: NDArray, hash_size: int = 8) -> int:
+    # difference-hash: signs of horizontal gradients of a (hash_size+1 x hash_size)
+    # thumbnail, robust to scale, brightness and jpeg-noise
+    thumb = Image.fromarray(gray.astype(np.uint8)).resize(
+        (hash_size + 1, hash_size), Image.BILINEAR
+    )
+    a = np.asarray(thumb, dtype=np.int16)
+    return int.from_bytes(np.packbits(a[:, 1:] > a[:, :-1]).tobytes(), "big")
+
+
+@dataclass
+class CropPrefilter:
+    # cheap decisions before a crop reaches the OCRInferencer:
+    # blank: (almost) no ink, printed: dhash is on the allowlist of printed labels,
+    # duplicate: pixel-identical to an already recognized crop whose result is
+    # reused; a dhash is far too coarse to reuse results by (handwritten "1" and "4"
+    # collide), it is only matched against the allowlist which is curated by hand
+    # and only read, dhashes seen on candidate_after_pages pages are merely written
+    # to candidates_file for review
+    min_ink_density: float = 0.01
+    candidate_after_pages: int = 20
+    allowlist_file: Optional[str] = None
+    candidates_file: Optional[str] = None
+    max_remembered: int = 10_000
+    counts: Counter = field(init=False, default_factory=Counter)
+    _allowlist: set[int] = field(init=False, default_factory=set, repr=False)
+    _page_counts: Counter = field(init=False, default_factory=Counter, repr=False)
+    _results: OrderedDict = field(init=False, default_factory=OrderedDict, repr=False)
+
+    def __post_init__(self):
+        if self.allowlist_file is not None and os.path.isfile(self.allowlist_file):
+            self._allowlist = {int(h, 16) for h in read_json(self.allowlist_file)}
+
+    def classify(self, crops: list[NDArray]) -> list[tuple[str, Optional[str]]]:
+        # returns decision and the exact content-hash to remember/recall results by
+        decisions, seen, seen_exact = [], set(), set()
+        for crop in crops:
+            gray = to_gray(crop)
+            if gray.size == 0 or ink_density(gray) < self.min_ink_density:
+                decisions.append((BLANK, None))
+                continue
+            h = dhash(gray)
+            seen.add(h)
+            if h in self._allowlist:
+                decisions.append((PRINTED, None))
+                continue
+            key = content_hash(Image.fromarray(crop), "crop")
+            if key in self._results or key in seen_exact:
+                decision = DUPLICATE
+            else:
+                decision = KEEP
+            seen_exact.add(key)
+            decisions.append((decision, key))
+        for h in seen:
+            self._page_counts[h] += 1
+        self.counts.update(d for d, _ in decisions)
+        return decisions
+
+    def remember(self, key: str, result: Any):
+        self._results[key] = result
+        self._results.move_to_end(key)
+        if len(self._results) > self.max_remembered:
+            self._results.popitem(last=False)
+
+    def recall(self, key: str) -> Optional[Any]:
+        return self._results.get(key)
+
+    def printed_candidates(self) -> dict[str, int]:
+        return {
+            f"{h:016x}": c
+            for h, c in self._page_counts.most_common()
+            if c >= self.candidate_after_pages and h not in self._allowlist
+        }
+
+    def save(self):
+        # never touches the allowlist, candidates are suggestions to look at
+        if self.candidates_file is not None:
+            write_json(self.candidates_file, self.printed_candidates())
@@ -0,0 +1,130 @@
+import os
+import pickle
+import shutil
+from dataclasses import dataclass, field
+from typing import Union
+
+import numpy as np
+from numpy.typing import NDArray
+from sklearn.decomposition import IncrementalPCA
+from tqdm import tqdm
+
+from data_io.readwrite_files import read_json, write_json
+from handwritten_ocr.embedding_store import EmbeddingStore, open_embedding_store
+from handwritten_ocr.trocr_inference import EmbeddedData
+from misc_utils.cached_data import ContinuedCachedData
+from misc_utils.dataclass_utils import UNDEFINED, _UNDEFINED
+from misc_utils.prefix_suffix import PrefixSuffix
+
+
+@dataclass
+class EmbeddingProjection(ContinuedCachedData):
+    # pca fitted minibatch-wise over the embedding-store (IncrementalPCA does the
+    # centering), each (continued) build only fits the rows appended since;
+    # the projected vectors are kept in their own EmbeddingStore (same row-numbers
+    # as the raw one), all of them projected by one frozen snapshot of the pca, new
+    # rows are projected with that snapshot, so only a refresh re-projects everything;
+    # refreshs happen automatically when the fitted rows grew by refresh_growth
+    name: Union[_UNDEFINED, str] = UNDEFINED
+    embedded_data: Union[_UNDEFINED, EmbeddedData] = UNDEFINED
+    n_components: int = 20
+    batch_size: int = field(default=10_000, repr=False)
+    refresh_growth: float = field(default=2.0, repr=False)
+
+    cache_base: PrefixSuffix = field(
+        default_factory=lambda: PrefixSuffix("cache_root", "embedding_projections")
+    )
+
+    @property
+    def model_pkl(self) -> str:
+        return self.prefix_cache_dir("pca.pkl")  # latest, still being fitted
+
+    @property
+    def state_json(self) -> str:
+        return self.prefix_cache_dir("state.json")
+
+    def _read_state(self) -> dict:
+        if os.path.isfile(self.state_json):
+            return read_json(self.state_json)
+        return {"num_fitted_rows": 0, "version": 0, "rows_at_version": 0}
+
+    def _snapshot_pkl(self, version: int) -> str:
+        return self.prefix_cache_dir(f"pca-v{version}.pkl")
+
+    def _store_dir(self, version: int) -> str:
+        return self.prefix_cache_dir(f"projected-v{version}")
+
+    @property
+    def store(self) -> EmbeddingStore:
+        return open_embedding_store(self._store_dir(self._read_state()["version"]))
+
+    def _load_model(self, file: str) -> IncrementalPCA:
+        if not hasattr(self, "_models"):
+            self._models = {}
+        if file not in self._models:
+            if os.path.isfile(file):
+                with open(file, "rb") as f:
+                    self._models[file] = pickle.load(f)
+            else:
+                self._models[file] = IncrementalPCA(n_components=self.n_components)
+        return self._models[file]
+
+    def transform(self, x: NDArray) -> NDArray:
+        # same snapshot that projected the vectors in store
+        pca = self._load_model(self._snapshot_pkl(self._read_state()["version"]))
+        return pca.transform(np.asarray(x, dtype=np.float32))
+
+    def _row_batches(self, start: int, stop: int) -> list[tuple[int, int]]:
+        # IncrementalPCA needs at least n_components rows per partial_fit, a
+        # smaller rest is left for the next build
+        batches = [
+            (k, min(k + self.batch_size, stop))
+            for k in range(start, stop, self.batch_size)
+        ]
+        return [(a, b) for a, b in batches if b - a >= self.n_components]
+
+    def refresh(self):
+        # snapshots the latest pca and re-projects all rows into a new store
+        state = self._read_state()
+        if state["num_fitted_rows"] == 0:
+            return
+        old_version = state["version"]
+        state["version"] += 1
+        state["rows_at_version"] = state["num_fitted_rows"]
+        shutil.copyfile(self.model_pkl, self._snapshot_pkl(state["version"]))
+        write_json(self.state_json, state)
+        if os.path.isdir(self._store_dir(old_version)):
+            shutil.rmtree(self._store_dir(old_version))
+        if os.path.isfile(self._snapshot_pkl(old_version)):
+            os.remove(self._snapshot_pkl(old_version))
+        self._project_new_rows()
+
+    def _project_new_rows(self):
+        raw, store = self.embedded_data.store, self.store
+        for k in tqdm(range(len(store), len(raw), self.batch_size), desc="projecting"):
+            store.append(self.transform(raw[k : min(k + self.batch_size, len(raw))]))
+
+    def continued_build_cache(self) -> None:
+        raw = self.embedded_data.store
+        state = self._read_state()
+        pca = self._load_model(self.model_pkl)
+        batches = self._row_batches(state["num_fitted_rows"], len(raw))
+        for a, b in tqdm(batches, desc="fitting pca"):
+            pca.partial_fit(np.asarray(raw[a:b], dtype=np.float32))
+
+        if len(batches) > 0:
+            with open(self.model_pkl, "wb") as f:
+                pickle.dump(pca, f)
+            state["num_fitted_rows"] = batches[-1][1]
+            write_json(self.state_json, state)
+
+        if state["num_fitted_rows"] == 0:
+            print(f"not enough rows to fit yet: {len(raw)=}")
+            return
+        grown = (
+            state["num_fitted_rows"] >= self.refresh_growth * state["rows_at_version"]
+        )
+        if state["version"] == 0 or grown:
+            self.refresh()
+        else:
+            self._project_new_rows()
@@ -0,0 +1,87 @@
+import os
+import shutil
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from data_io.readwrite_files import read_json, write_json
+
+
+@dataclass
+class EmbeddingStore:
+    # append-only row-major matrix in one raw file, rows are read zero-copy via a
+    # read-only memmap; the row-number is all a datum needs to find its embedding
+    directory: str
+    dim: Optional[int] = None
+    dtype: str = "float32"
+    _memmap: Optional[np.memmap] = field(init=False, default=None, repr=False)
+
+    def __post_init__(self):
+        if os.path.isfile(self.meta_json):
+            meta = read_json(self.meta_json)
+            self.dim, self.dtype = meta["dim"], meta["dtype"]
+
+    @property
+    def data_file(self) -> str:
+        return f"{self.directory}/embeddings.bin"
+
+    @property
+    def meta_json(self) -> str:
+        return f"{self.directory}/meta.json"
+
+    @property
+    def row_nbytes(self) -> int:
+        return self.dim * np.dtype(self.dtype).itemsize
+
+    def __len__(self) -> int:
+        if self.dim is None or not os.path.isfile(self.data_file):
+            return 0
+        # a partially written last row (crashed append) is not counted
+        return os.path.getsize(self.data_file) // self.row_nbytes
+
+    def append(self, arrays: NDArray) -> range:
+        if self.dim is None or not os.path.isfile(self.meta_json):
+            # also when the directory was removed underneath an opened store
+            self.dim, self._memmap = arrays.shape[1], None
+            os.makedirs(self.directory, exist_ok=True)
+            write_json(self.meta_json, {"dim": self.dim, "dtype": self.dtype})
+        assert arrays.ndim == 2 and arrays.shape[1] == self.dim, f"{arrays.shape=}"
+
+        start = len(self)
+        with open(self.data_file, "ab") as f:
+            f.truncate(start * self.row_nbytes)
+            f.write(np.ascontiguousarray(arrays, dtype=self.dtype).tobytes())
+        self._memmap = None
+        return range(start, start + len(arrays))
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.dim, self._memmap = None, None
+
+    @property
+    def matrix(self) -> NDArray:
+        num_rows = len(self)
+        if num_rows == 0:
+            return np.zeros((0, self.dim or 0), dtype=self.dtype)
+        if self._memmap is None or len(self._memmap) != num_rows:
+            self._memmap = np.memmap(
+                self.data_file, dtype=self.dtype, mode="r", shape=(num_rows, self.dim)
+            )
+        return self._memmap
+
+    def __getitem__(self, rows: Union[int, slice, NDArray]) -> NDArray:
+        return self.matrix[rows]
+
+
+_OPENED_STORES: dict[str, EmbeddingStore] = {}
+
+
+def open_embedding_store(directory: str, dtype: str = "float32") -> EmbeddingStore:
+    # one store (and memmap) per directory and process, a store whose directory
+    # got removed (e.g. cache rebuilt) is reopened to not keep its stale dim
+    store = _OPENED_STORES.get(directory)
+    if store is None or (store.dim is not None and not os.path.isfile(store.meta_json)):
+        _OPENED_STORES[directory] = EmbeddingStore(directory, dtype=dtype)
+    return _OPENED_STORES[directory]
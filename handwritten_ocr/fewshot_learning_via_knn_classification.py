@@ -1,19 +1,15 @@
-import itertools
 import os
-from pathlib import Path
 
 import numpy as np
-from sklearn.decomposition import PCA
 from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import StandardScaler
-from tqdm import tqdm
 
 from data_io.readwrite_files import read_lines, write_file
+from handwritten_ocr.ann_index import EmbeddingsIVFIndex
 from handwritten_ocr.craft_text_detection import CraftCroppedImages
+from handwritten_ocr.embedding_projection import EmbeddingProjection
 from handwritten_ocr.pdf_to_images import ImagesFromPdf
 from handwritten_ocr.trocr_inference import OCRInferencer, EmbeddedData
-from misc_utils.prefix_suffix import PrefixSuffix
+from misc_utils.prefix_suffix import BASE_PATHES, PrefixSuffix
 from misc_utils.utils import build_markdown_table_from_dicts
 
 
@@ -41,21 +37,29 @@ if __name__ == "__main__":
 
     data_path = os.environ["DATA_PATH"]
 
+    BASE_PATHES["data_path"] = data_path
+    BASE_PATHES["cache_root"] = f"{data_path}/cache"
+
+    inferencer = OCRInferencer(model_name="microsoft/trocr-base-handwritten")
     embedded_data = EmbeddedData(
         name="debug",
-        embeddings=TrOCREmbeddings(
-            inferencer=OCRInferencer(model_name="microsoft/trocr-base-handwritten"),
-            files=CraftCroppedImages(
-                name="debug",
-                image_files=ImagesFromPdf(
-                    pdf_file=PrefixSuffix(
-                        "data_path",
-                        "handwritten_ocr/data/e14_cong_2018__e14_divulgacion_01_001_001_CAM_E14_CAM_X_01_001_001_XX_01_005_X_XXX.pdf",
-                    )
-                ),
+        inferencer=inferencer,
+        images=CraftCroppedImages(
+            name="debug",
+            image_files=ImagesFromPdf(
+                pdf_file=PrefixSuffix(
+                    "data_path",
+                    "handwritten_ocr/data/e14_cong_2018__e14_divulgacion_01_001_001_CAM_E14_CAM_X_01_001_001_XX_01_005_X_XXX.pdf",
+                )
             ),
+            persist_crops=True,  # to have images for the predictions.md
         ),
     ).build()
+    # fitted incrementally, only new embeddings are fitted+projected on rebuild
+    projection = EmbeddingProjection(name="debug", embedded_data=embedded_data).build()
+    index = EmbeddingsIVFIndex(
+        name="debug", embedded_data=embedded_data, num_lists=16
+    ).build()
 
     # write_file("annotations.md",build_markdown_table_from_dicts(annotated_data))
     train_data = [
@@ -65,11 +69,7 @@ if __name__ == "__main__":
     ]
     print(train_data)
 
-    file_embeddings = [
-        (f, embedder.embedd_image(f"{data_path}/{f}").detach().numpy())
-        for _, _, f in train_data
-    ]
-    X = np.concatenate([[x] for _, x in file_embeddings])
+    X = inferencer.embedd_batch([f"{data_path}/{f}" for _, _, f in train_data]).numpy()
     print(f"{X.shape=}")
     # y = np.array([y for _, y, _ in examples])
     # n_neighbors = 1
@@ -77,47 +77,22 @@ if __name__ == "__main__":
     # clf = neighbors.KNeighborsClassifier(n_neighbors, weights=weights)
     # clf.fit(X, y)
 
-    path = f"{data_path}/e14_cong_2018__e14_divulgacion_01_001_001_CAM_E14_CAM_X_01_001_001_XX_01_005_X_XXX.pdf-0/e14_cong_2018__e14_divulgacion_01_001_001_CAM_E14_CAM_X_01_001_001_XX_01_005_X_XXX.pdf-0_crops"
-    files = Path(path).rglob("crop_*.png")
-
-    def get_predictions(p):
-        x = embedder.embedd_image(str(p))
-        x = x.detach().numpy()
-        # x = np.expand_dims(x, 0)
-        # o = clf.predict_proba(x).squeeze()
-        # o=cosine_similarity(x,np.expand_dims(X[0],0))
-        return x
-
-    files = list(itertools.islice(files, 0, 100))
-    file_embeddings_unlabeled = (
-        (
-            str(p).replace(f"{base_path}/", ""),
-            get_predictions(p),
-        )
-        for p in files
-    )
-    unlabeled = np.array(
-        [x for _, x in tqdm(file_embeddings_unlabeled, desc="calc embeddings")]
-    )
-    print(f"{unlabeled.shape=}")
-
-    pipeline = Pipeline(
-        [("scaling", StandardScaler()), ("pca", PCA(random_state=42, n_components=20))]
-    )
-    # print(f"{std_scaler.mean_=},{std_scaler.scale_=}")
-    unlabeld_svd = pipeline.fit_transform(unlabeled)
-    labeled_svd = pipeline.transform(X)
+    # ann-index retrieves candidates, they get re-ranked in the projected space
+    rows, _ = index.search(X[:1], k=100)
+    rows = rows[0][rows[0] >= 0]
+    labeled_svd = projection.transform(X[:1])
+    unlabeld_svd = projection.store[np.sort(rows)]
     print(f"{unlabeld_svd.shape=},{labeled_svd.shape=}")
-    print(f"{unlabeld_svd=},{labeled_svd=}")
-    sims = cosine_similarity(labeled_svd, unlabeld_svd).squeeze()
-    print(f"{sims.shape=}")
+    sims = cosine_similarity(labeled_svd, unlabeld_svd).squeeze(0)
+    row2sim = dict(zip(np.sort(rows).tolist(), sims))
     g = (
         {
-            "idx": k,
-            "cosine_similarity": sim,
-            "image": image_in_markdown(file),
+            "idx": d.row,
+            "cosine_similarity": row2sim[d.row],
+            "image": image_in_markdown(d.cropped_image_file),
         }
-        for k, (sim, file) in enumerate(zip(sims, files))
+        for d in embedded_data.iter_rows(rows=slice(min(row2sim), max(row2sim) + 1))
+        if d.row in row2sim
     )
     write_file(
         f"predictions.md",
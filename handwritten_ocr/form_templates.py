@@ -0,0 +1,170 @@
+import os
+import re
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
+
+import numpy as np
+from numpy.typing import NDArray
+from tqdm import tqdm
+
+from craft_text_detector.image_utils import read_image
+from data_io.readwrite_files import read_json, write_json
+from handwritten_ocr.craft_text_detection import (
+    CRAFT_KWARGS,
+    CraftPool,
+    CroppedImage,
+)
+from misc_utils.cached_data_specific import CachedDataclasses
+from misc_utils.dataclass_utils import UNDEFINED, _UNDEFINED
+from misc_utils.prefix_suffix import PrefixSuffix
+
+FORM_TYPE_REGEX = re.compile(r"(E\d\d|AGE|AUD|FRT)_(CAM|SEN|XXX)")
+
+
+def form_type_from_filename(file_name: str) -> Optional[str]:
+    # esc_cong_2018_archivos_divulgacion_E24_CAM_2_50_... -> E24_CAM
+    # e14_cong_2018__e14_divulgacion_01_001_001_CAM_E14_CAM_X_... -> E14_CAM
+    m = FORM_TYPE_REGEX.search(Path(file_name).name)
+    return m.group(0) if m is not None else None
+
+
+def page_index_from_filename(image_file: str) -> int:
+    # page-images are named <pdf-name>-<page-index>.jpg (see ImagesFromPdf)
+    return int(Path(image_file).stem.rsplit("-", 1)[1])
+
+
+@dataclass
+class TemplateCell:
+    name: str
+    box: list[float]  # x0, y0, x1, y1 relative to the page's content-box
+
+
+@dataclass
+class FormTemplate:
+    form_type: str
+    page_index: int
+    cells: list[TemplateCell]
+
+
+FORM_TEMPLATES: dict[tuple[str, int], FormTemplate] = {}
+
+
+def register_form_template(template: FormTemplate):
+    FORM_TEMPLATES[(template.form_type, template.page_index)] = template
+
+
+def load_form_templates(templates_dir: str):
+    for p in sorted(Path(templates_dir).glob("*.json")):
+        d = read_json(str(p))
+        register_form_template(
+            FormTemplate(
+                form_type=d["form_type"],
+                page_index=d["page_index"],
+                cells=[TemplateCell(**c) for c in d["cells"]],
+            )
+        )
+
+
+def save_form_template(template: FormTemplate, templates_dir: str):
+    os.makedirs(templates_dir, exist_ok=True)
+    write_json(
+        f"{templates_dir}/{template.form_type}-{template.page_index}.json",
+        asdict(template),
+    )
+
+
+def content_box(page: NDArray, min_ink_fraction: float = 0.01) -> NDArray:
+    # bounding box (x0, y0, x1, y1) of the rows/columns that carry printed ink,
+    # makes cell-coordinates invariant to the scan's offset and scale
+    gray = page.mean(axis=2) if page.ndim == 3 else page
+    ink = gray < 128
+    cols = np.flatnonzero(ink.mean(axis=0) > min_ink_fraction)
+    rows = np.flatnonzero(ink.mean(axis=1) > min_ink_fraction)
+    if len(cols) == 0 or len(rows) == 0:
+        return np.array([0, 0, page.shape[1], page.shape[0]], dtype=np.float64)
+    return np.array([cols[0], rows[0], cols[-1] + 1, rows[-1] + 1], dtype=np.float64)
+
+
+def template_from_reference(
+    form_type: str,
+    page_index: int,
+    page: NDArray,
+    boxes: Iterable[NDArray],
+    names: Optional[list[str]] = None,
+) -> FormTemplate:
+    # derives a template from the boxes (e.g. craft-detected and filtered down to
+    # the tally-cells) of one well scanned reference page
+    x0, y0, x1, y1 = content_box(page)
+    scale = np.array([x1 - x0, y1 - y0, x1 - x0, y1 - y0])
+    offset = np.array([x0, y0, x0, y0])
+    cells = []
+    for k, b in enumerate(boxes):
+        b = np.asarray(b).reshape(-1, 2)
+        absolute = np.concatenate([b.min(axis=0), b.max(axis=0)])
+        relative = (absolute - offset) / scale
+        name = names[k] if names is not None else f"cell-{k}"
+        cells.append(TemplateCell(name=name, box=relative.round(5).tolist()))
+    return FormTemplate(form_type=form_type, page_index=page_index, cells=cells)
+
+
+def template_cell_boxes(
+    page: NDArray, template: FormTemplate
+) -> list[list[list[float]]]:
+    # cell-boxes in page pixel-coordinates as 4-point polygons (like craft's boxes)
+    x0, y0, x1, y1 = content_box(page).tolist()
+    boxes = []
+    for c in template.cells:
+        cx0, cy0 = x0 + c.box[0] * (x1 - x0), y0 + c.box[1] * (y1 - y0)
+        cx1, cy1 = x0 + c.box[2] * (x1 - x0), y0 + c.box[3] * (y1 - y0)
+        boxes.append([[cx0, cy0], [cx1, cy0], [cx1, cy1], [cx0, cy1]])
+    return boxes
+
+
+def crop_template_cells(
+    page: NDArray, template: FormTemplate
+) -> Iterator[tuple[TemplateCell, NDArray]]:
+    # cells are axis-aligned, so crops are plain views into the page-array
+    for cell, box in zip(template.cells, template_cell_boxes(page, template)):
+        (cx0, cy0), (cx1, cy1) = box[0], box[2]
+        yield cell, page[
+            max(0, round(cy0)) : max(0, round(cy1)),
+            max(0, round(cx0)) : max(0, round(cx1)),
+        ]
+
+
+@dataclass
+class TemplateCroppedImages(CachedDataclasses[CroppedImage]):
+    # known layouts (form-type + page-index) are cut along their template-cells,
+    # craft-detection is only the fallback for pages without a template
+    # image_files should be RegisteredPages, templates assume deskewed pages
+    name: Union[_UNDEFINED, str] = UNDEFINED
+    image_files: Union[_UNDEFINED, Iterable[PrefixSuffix]] = UNDEFINED
+    templates_dir: Union[_UNDEFINED, str] = UNDEFINED
+    cache_base: PrefixSuffix = field(
+        default_factory=lambda: PrefixSuffix("cache_root", "cropped_images")
+    )
+
+    def generate_dataclasses_to_cache(self) -> Iterator[CroppedImage]:
+        load_form_templates(self.templates_dir)
+        num_detected = 0
+        for f in tqdm(self.image_files, desc="template-cropping"):
+            key = (form_type_from_filename(str(f)), page_index_from_filename(str(f)))
+            page = read_image(str(f))
+            if key in FORM_TEMPLATES:
+                boxes = template_cell_boxes(page, FORM_TEMPLATES[key])
+                polys = boxes  # template-cells are plain rectangles
+            else:
+                num_detected += 1
+                craft = CraftPool.get(**CRAFT_KWARGS)
+                r = craft.detect_text(page)
+                boxes = [b.tolist() for b in r["boxes"]]
+                polys = [np.asarray(p).tolist() for p in r["polys"]]
+            for b, p in zip(boxes, polys):
+                yield CroppedImage(
+                    image_file=self.cache_dir.from_str_same_prefix(str(f)),
+                    cropped_image_file=None,
+                    box=b,
+                    poly=p,
+                )
+        print(f"{num_detected} pages had no template and went through craft")
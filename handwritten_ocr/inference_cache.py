@@ -0,0 +1,72 @@
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+from numpy.typing import NDArray
+from PIL import Image
+
+
+def content_hash(image: Image.Image, namespace: str) -> str:
+    # namespace should name the model and everything else the result depends on
+    h = hashlib.sha1(namespace.encode("utf-8"))
+    h.update(f"{image.mode}-{image.size}".encode("utf-8"))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+@dataclass
+class InferenceCache:
+    # content-addressed on-disk cache (one .npy per key), bounded to max_bytes by
+    # evicting the least recently used entries; file-mtimes serve as access-times
+    # so the lru-order survives restarts
+    directory: str
+    max_bytes: int = 2**30
+    _entries: OrderedDict = field(init=False, default_factory=OrderedDict, repr=False)
+    _num_bytes: int = field(init=False, default=0, repr=False)
+
+    def __post_init__(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = [
+            (e.stat().st_mtime, e.name[: -len(".npy")], e.stat().st_size)
+            for d in os.scandir(self.directory)
+            if d.is_dir()
+            for e in os.scandir(d.path)
+            if e.name.endswith(".npy")
+        ]
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._num_bytes += size
+
+    def _file(self, key: str) -> str:
+        return f"{self.directory}/{key[:2]}/{key}.npy"
+
+    def get(self, key: str) -> Optional[NDArray]:
+        if key not in self._entries:
+            return None
+        try:
+            array = np.load(self._file(key))
+            os.utime(self._file(key))
+        except FileNotFoundError:  # evicted by another process
+            self._num_bytes -= self._entries.pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return array
+
+    def put(self, key: str, array: NDArray):
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp_file = f"{file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_file, file)
+        size = os.path.getsize(file)
+        self._num_bytes += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        while self._num_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest, size = self._entries.popitem(last=False)
+            self._num_bytes -= size
+            if os.path.isfile(self._file(oldest)):
+                os.remove(self._file(oldest))
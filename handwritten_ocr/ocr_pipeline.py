@@ -0,0 +1,212 @@
+import os
+import traceback
+from dataclasses import dataclass, field, asdict
+from queue import Queue
+from threading import Thread
+from time import time
+from typing import Any, Callable, Iterator, Optional, Union
+
+import numpy as np
+from numpy.typing import NDArray
+from pdf2image import convert_from_path, pdfinfo_from_path
+from tqdm import tqdm
+
+from data_io.readwrite_files import write_jsonl
+from handwritten_ocr.craft_text_detection import CRAFT_KWARGS, CraftPool, crop_boxes
+from handwritten_ocr.crop_prefilter import CropPrefilter, DUPLICATE, KEEP
+from handwritten_ocr.trocr_inference import OCRInferencer
+from misc_utils.buildable import Buildable
+from misc_utils.dataclass_utils import UNDEFINED, _UNDEFINED
+
+_DONE = object()
+
+
+@dataclass
+class StageStats:
+    name: str
+    num_items: int = 0
+    busy_seconds: float = 0.0
+    num_failed: int = 0
+
+    @property
+    def items_per_sec(self) -> float:
+        return self.num_items / self.busy_seconds if self.busy_seconds > 0 else 0.0
+
+
+@dataclass
+class PageArray:
+    pdf_file: str
+    page_index: int
+    array: NDArray = field(repr=False)
+
+
+@dataclass
+class PageCrops:
+    pdf_file: str
+    page_index: int
+    boxes: list[list[list[float]]]
+    crops: list[NDArray] = field(repr=False)
+
+
+@dataclass
+class OCRedCrop:
+    pdf_file: str
+    page_index: int
+    box: list[list[float]]
+    text: str
+    embedding: Optional[NDArray] = field(default=None, repr=False)
+
+
+@dataclass
+class StreamingOCRPipeline(Buildable):
+    # pdf -> pages -> craft-boxes -> trocr-text, every stage runs in its own thread,
+    # stages are connected by bounded queues so they overlap and memory stays bounded,
+    # (pdftoppm, craft and torch do their heavy lifting outside of the GIL)
+    pdf_files: Union[_UNDEFINED, list[str]] = UNDEFINED
+    inferencer: Union[_UNDEFINED, OCRInferencer] = UNDEFINED
+    queue_size: int = 4
+    dpi: int = 200
+    with_embeddings: bool = False  # embeddings come from the same encoder-pass
+    prefilter: Optional[CropPrefilter] = None
+
+    def _build_self(self) -> Any:
+        self.stats = {
+            name: StageStats(name) for name in ["rasterize", "detect", "recognize"]
+        }
+
+    def _rasterize(self, pdf_file: str) -> Iterator[PageArray]:
+        num_pages = pdfinfo_from_path(pdf_file)["Pages"]
+        for k in range(num_pages):
+            (page,) = convert_from_path(
+                pdf_file, self.dpi, first_page=k + 1, last_page=k + 1
+            )
+            yield PageArray(pdf_file, k, np.asarray(page.convert("RGB")))
+
+    def _detect(self, page: PageArray) -> Iterator[PageCrops]:
+        craft = CraftPool.get(**CRAFT_KWARGS)
+        r = craft.detect_text(page.array)
+        yield PageCrops(
+            page.pdf_file,
+            page.page_index,
+            [b.tolist() for b in r["boxes"]],
+            crop_boxes(page.array, r["polys"]),  # like craft's crop_type="poly"
+        )
+
+    def _recognize_crops(self, crops: list[NDArray]) -> list[tuple]:
+        if len(crops) == 0:
+            return []
+        elif self.with_embeddings:
+            embeddings, texts = self.inferencer.embedd_and_ocr_batch(crops)
+            return list(zip(texts, embeddings.numpy()))
+        else:
+            return [(text, None) for text in self.inferencer.ocr_batch(crops)]
+
+    def _recognize(self, page: PageCrops) -> Iterator[list[OCRedCrop]]:
+        if self.prefilter is None:
+            results = self._recognize_crops(page.crops)
+            boxes = page.boxes
+        else:
+            # blank and printed crops are dropped, duplicates reuse the result
+            # of the first pixel-identical crop
+            decisions = self.prefilter.classify(page.crops)
+            todo = [k for k, (d, _) in enumerate(decisions) if d == KEEP]
+            recognized = self._recognize_crops([page.crops[k] for k in todo])
+            for k, result in zip(todo, recognized):
+                self.prefilter.remember(decisions[k][1], result)
+            kept = [
+                (box, self.prefilter.recall(key))
+                for box, (d, key) in zip(page.boxes, decisions)
+                if d in [KEEP, DUPLICATE]
+            ]
+            kept = [(box, r) for box, r in kept if r is not None]
+            boxes, results = [b for b, _ in kept], [r for _, r in kept]
+        yield [
+            OCRedCrop(page.pdf_file, page.page_index, box, text, embedding)
+            for box, (text, embedding) in zip(boxes, results)
+        ]
+
+    def _run_stage(
+        self,
+        name: str,
+        fun: Callable[[Any], Iterator[Any]],
+        inbox: Queue,
+        outbox: Queue,
+    ):
+        stats = self.stats[name]
+        try:
+            for item in iter(inbox.get, _DONE):
+                outputs = fun(item)
+                while True:
+                    start = time()
+                    try:
+                        output = next(outputs)
+                    except StopIteration:
+                        break
+                    except Exception:
+                        stats.num_failed += 1
+                        print(f"{name} failed on {item}")
+                        traceback.print_exc()
+                        break
+                    finally:
+                        stats.busy_seconds += time() - start
+                    stats.num_items += 1
+                    outbox.put(output)
+        finally:
+            outbox.put(_DONE)
+
+    def __iter__(self) -> Iterator[OCRedCrop]:
+        pdfs, pages, crops, results = (
+            Queue(),
+            Queue(maxsize=self.queue_size),
+            Queue(maxsize=self.queue_size),
+            Queue(maxsize=self.queue_size),
+        )
+        for f in self.pdf_files:
+            pdfs.put(f)
+        pdfs.put(_DONE)
+
+        stages = [
+            ("rasterize", self._rasterize, pdfs, pages),
+            ("detect", self._detect, pages, crops),
+            ("recognize", self._recognize, crops, results),
+        ]
+        threads = [
+            Thread(target=self._run_stage, args=stage, daemon=True) for stage in stages
+        ]
+        for t in threads:
+            t.start()
+
+        pbar = tqdm(iter(results.get, _DONE), desc="ocr-pipeline (pages)")
+        for ocred_crops in pbar:
+            pbar.set_postfix(
+                pages_queue=pages.qsize(),
+                crops_queue=crops.qsize(),
+                **(self.prefilter.counts if self.prefilter is not None else {}),
+                **{
+                    f"{s.name}_per_sec": f"{s.items_per_sec:.2f}"
+                    for s in self.stats.values()
+                },
+            )
+            yield from ocred_crops
+
+        for t in threads:
+            t.join()
+        print(f"{list(self.stats.values())=}")
+        if self.prefilter is not None:
+            self.prefilter.save()
+            print(f"prefilter skipped crops: {dict(self.prefilter.counts)}")
+
+
+if __name__ == "__main__":
+    data_path = os.environ["DATA_PATH"]
+    pipeline = StreamingOCRPipeline(
+        pdf_files=[
+            f"{data_path}/handwritten_ocr/data/e14_cong_2018__e14_divulgacion_01_001_001_CAM_E14_CAM_X_01_001_001_XX_01_005_X_XXX.pdf"
+        ],
+        inferencer=OCRInferencer(model_name="microsoft/trocr-base-handwritten"),
+        prefilter=CropPrefilter(
+            allowlist_file=f"{data_path}/printed_crops_allowlist.json",
+            candidates_file=f"{data_path}/printed_crops_candidates.json",
+        ),
+    ).build()
+    write_jsonl("ocred_crops.jsonl", (asdict(r) for r in pipeline))
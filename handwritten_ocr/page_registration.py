@@ -0,0 +1,157 @@
+import os
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Iterable, Iterator, Union
+
+import numpy as np
+from numpy.typing import NDArray
+from PIL import Image
+from tqdm import tqdm
+
+from data_io.readwrite_files import write_jsonl
+from handwritten_ocr.form_templates import TemplateCroppedImages
+from handwritten_ocr.pdf_to_images import ImagesFromPdf
+from misc_utils.cached_data import CachedData
+from misc_utils.dataclass_utils import UNDEFINED, _UNDEFINED
+from misc_utils.prefix_suffix import PrefixSuffix, BASE_PATHES
+
+
+@dataclass
+class PageTransform:
+    # rotation (degrees) about the page-center followed by a translation, maps the
+    # scanned page onto a deskewed page whose printed content starts at the margin
+    angle: float
+    dx: float
+    dy: float
+    width: int
+    height: int
+
+
+def ink_coordinates(gray: NDArray, max_points: int = 50_000) -> NDArray:
+    ys, xs = np.nonzero(gray < 128)
+    xy = np.stack([xs, ys], axis=1).astype(np.float32)
+    if len(xy) > max_points:
+        xy = xy[:: len(xy) // max_points]
+    return xy
+
+
+def rotate_points(xy: NDArray, angles: NDArray, center: NDArray) -> NDArray:
+    rad = np.deg2rad(angles)[:, None]
+    x, y = (xy - center).T
+    rx = x * np.cos(rad) + y * np.sin(rad)
+    ry = -x * np.sin(rad) + y * np.cos(rad)
+    return np.stack([rx, ry], axis=2) + center
+
+
+def estimate_skew(
+    xy: NDArray, center: NDArray, max_angle: float = 5.0, step: float = 0.1
+) -> float:
+    # projection-profile method: printed rule-lines and text-rows give the sharpest
+    # row-histogram (largest sum of squared bin-counts) once they are horizontal
+    if len(xy) == 0:
+        return 0.0
+    angles = np.arange(-max_angle, max_angle + step / 2, step)
+    rad = np.deg2rad(angles).astype(np.float32)[:, None]
+    x, y = (xy - center).T
+    rows = np.round(y * np.cos(rad) - x * np.sin(rad)).astype(np.int64)
+    rows -= rows.min()
+    num_rows = rows.max() + 1
+    offsets = np.arange(len(angles))[:, None] * num_rows
+    profiles = np.bincount((rows + offsets).ravel(), minlength=len(angles) * num_rows)
+    scores = (profiles.reshape(len(angles), num_rows).astype(np.float64) ** 2).sum(1)
+    return round(float(angles[np.argmax(scores)]), 3)
+
+
+def estimate_transform(
+    page: Image.Image, margin: int = 20, max_angle: float = 5.0
+) -> PageTransform:
+    gray = np.asarray(page.convert("L"))
+    center = np.array([gray.shape[1], gray.shape[0]], dtype=np.float32) / 2
+    xy = ink_coordinates(gray)
+    angle = estimate_skew(xy, center, max_angle)
+    if len(xy) == 0:
+        return PageTransform(angle, 0.0, 0.0, gray.shape[1], gray.shape[0])
+    # offset from the (robust) bounding box of the deskewed ink, outliers like
+    # scanner-borders or specks should not shift the page
+    (rotated,) = rotate_points(xy, np.array([angle]), center)
+    x0, y0 = np.percentile(rotated, 0.1, axis=0)
+    x1, y1 = np.percentile(rotated, 99.9, axis=0)
+    return PageTransform(
+        angle=angle,
+        dx=float(margin - x0),
+        dy=float(margin - y0),
+        width=int(np.ceil(x1 - x0)) + 2 * margin,
+        height=int(np.ceil(y1 - y0)) + 2 * margin,
+    )
+
+
+def apply_transform(page: Image.Image, t: PageTransform) -> Image.Image:
+    # single resampling-step, PIL's affine-transform wants the output->input mapping
+    c, s = np.cos(np.deg2rad(t.angle)), np.sin(np.deg2rad(t.angle))
+    cx, cy = page.width / 2, page.height / 2
+    u0, v0 = -(cx + t.dx), -(cy + t.dy)
+    coeffs = (c, -s, c * u0 - s * v0 + cx, s, c, s * u0 + c * v0 + cy)
+    return page.transform(
+        (t.width, t.height),
+        Image.AFFINE,
+        coeffs,
+        resample=Image.BILINEAR,
+        fillcolor="white" if page.mode != "L" else 255,
+    )
+
+
+@dataclass
+class RegisteredPages(CachedData, Iterable[PrefixSuffix]):
+    # deskewed and shifted page-images, so that template-cells (see form_templates)
+    # can be cut by coordinates and craft gets smaller, cleaner pages;
+    # page-images keep their file-names, transforms are cached in transforms.jsonl
+    name: Union[_UNDEFINED, str] = UNDEFINED
+    image_files: Union[_UNDEFINED, Iterable[PrefixSuffix]] = UNDEFINED
+    margin: int = 20
+    max_angle: float = 5.0
+    cache_base: PrefixSuffix = field(
+        default_factory=lambda: PrefixSuffix("cache_root", "registered_pages")
+    )
+
+    @property
+    def output_dir(self):
+        return self.prefix_cache_dir("data")
+
+    @property
+    def transforms_jsonl(self):
+        return self.prefix_cache_dir("transforms.jsonl")
+
+    def _build_cache(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        for f in tqdm(self.image_files, desc="registering pages"):
+            page = Image.open(str(f))
+            t = estimate_transform(page, self.margin, self.max_angle)
+            apply_transform(page, t).save(f"{self.output_dir}/{Path(str(f)).name}")
+            write_jsonl(
+                self.transforms_jsonl,
+                [{"image_file": str(f)} | asdict(t)],
+                mode="ab",
+            )
+
+    def __iter__(self) -> Iterator[PrefixSuffix]:
+        for p in sorted(Path(self.output_dir).glob("*.jpg")):
+            yield self.cache_dir.from_str_same_prefix(str(p))
+
+
+if __name__ == "__main__":
+    data_path = os.environ["DATA_PATH"]
+    BASE_PATHES["data_path"] = data_path
+    BASE_PATHES["cache_root"] = f"{data_path}/cache"
+
+    pdf_file = PrefixSuffix(
+        "data_path",
+        "handwritten_ocr/data/e14_cong_2018__e14_divulgacion_01_001_001_CAM_E14_CAM_X_01_001_001_XX_01_005_X_XXX.pdf",
+    )
+    # ImagesFromPdf -> RegisteredPages -> template-cells or craft on the remainder
+    TemplateCroppedImages(
+        name="debug",
+        image_files=RegisteredPages(
+            name="debug", image_files=ImagesFromPdf(pdf_file=pdf_file)
+        ),
+        templates_dir=f"{data_path}/form_templates",
+    ).build()
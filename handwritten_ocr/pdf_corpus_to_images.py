@@ -0,0 +1,105 @@
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import time
+from typing import Optional, Union
+
+from tqdm import tqdm
+
+from data_io.readwrite_files import read_jsonl, write_jsonl
+from handwritten_ocr.pdf_to_images import ImagesFromPdf
+from misc_utils.cached_data import ContinuedCachedData
+from misc_utils.dataclass_utils import UNDEFINED, _UNDEFINED
+from misc_utils.prefix_suffix import BASE_PATHES, PrefixSuffix
+
+
+def _init_worker(base_pathes: dict[str, str]):
+    # spawned workers do not inherit the BASE_PATHES set up in __main__
+    BASE_PATHES.update(base_pathes)
+
+
+def _rasterize_pdf(
+    pdf_file: PrefixSuffix, cache_base: PrefixSuffix
+) -> tuple[str, float, Optional[str]]:
+    start = time()
+    try:
+        ImagesFromPdf(pdf_file=pdf_file, cache_base=cache_base).build()
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return Path(str(pdf_file)).name, time() - start, error
+
+
+@dataclass
+class ImagesFromPdfCorpus(ContinuedCachedData):
+    # every pdf in data_dir (as written by the scrapers) gets its own ImagesFromPdf-cache,
+    # finished ones are recorded in done.jsonl and skipped when continuing
+    data_dir: Union[_UNDEFINED, PrefixSuffix] = UNDEFINED
+    name: Union[_UNDEFINED, str] = UNDEFINED
+    num_workers: int = field(default=os.cpu_count(), repr=False)
+    images_cache_base: PrefixSuffix = field(
+        default_factory=lambda: PrefixSuffix("cache_root", "pdf_page_images")
+    )
+
+    @property
+    def done_jsonl(self):
+        return self.prefix_cache_dir("done.jsonl")
+
+    @property
+    def failures_jsonl(self):
+        return self.prefix_cache_dir("failures.jsonl")
+
+    def continued_build_cache(self) -> None:
+        already_done = (
+            {d["pdf_file"] for d in read_jsonl(self.done_jsonl)}
+            if os.path.isfile(self.done_jsonl)
+            else set()
+        )
+        todo = [
+            self.data_dir.from_str_same_prefix(str(p))
+            for p in sorted(Path(str(self.data_dir)).glob("*.pdf"))
+            if p.name not in already_done
+        ]
+        print(f"already done: {len(already_done)}, {len(todo)} still TODO")
+
+        num_failed = 0
+        start = time()
+        with ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=_init_worker,
+            initargs=(dict(BASE_PATHES),),
+        ) as executor:
+            results = executor.map(
+                _rasterize_pdf,
+                todo,
+                [self.images_cache_base] * len(todo),
+                chunksize=8,
+            )
+            pbar = tqdm(results, total=len(todo), desc="rasterizing pdfs")
+            for k, (pdf_file, duration, error) in enumerate(pbar, start=1):
+                datum = {"pdf_file": pdf_file, "duration": duration}
+                if error is None:
+                    write_jsonl(self.done_jsonl, [datum], mode="ab")
+                else:
+                    num_failed += 1
+                    write_jsonl(
+                        self.failures_jsonl, [datum | {"error": error}], mode="ab"
+                    )
+                pbar.set_postfix(
+                    failed=num_failed, pdfs_per_sec=f"{k / (time() - start):.2f}"
+                )
+        print(f"processed {len(todo)} pdfs, {num_failed} failed")
+
+
+if __name__ == "__main__":
+    data_path = os.environ["DATA_PATH"]
+    BASE_PATHES["data_path"] = data_path
+    BASE_PATHES["cache_root"] = f"{data_path}/cache"
+
+    ImagesFromPdfCorpus(
+        name="e14_cong_2018",
+        data_dir=PrefixSuffix("data_path", "e14_cong_2018/data"),
+        cache_base=PrefixSuffix("cache_root", "pdf_corpora"),
+    ).build()
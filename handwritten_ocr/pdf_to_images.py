@@ -1,13 +1,18 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any, Callable, Union, Iterator, Iterable
 
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from numpy.typing import NDArray
+from PIL import Image
 from PIL.PpmImagePlugin import PpmImageFile
 from misc_utils.cached_data import CachedData
 from misc_utils.dataclass_utils import _UNDEFINED, UNDEFINED
 from misc_utils.prefix_suffix import PrefixSuffix, BASE_PATHES
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 from tqdm import tqdm
 
 from misc_utils.buildable import Buildable
@@ -24,6 +29,7 @@ class CroppedImages(CachedData, Iterable[str]):
     y_step_size_fun: Callable[[PpmImageFile], int] = field(
         default=lambda page: round(1.41 * page.width / 30)
     )
+    save_crops: bool = True
 
     @property
     def name(self):
@@ -34,8 +40,12 @@ class CroppedImages(CachedData, Iterable[str]):
         return self.prefix_cache_dir("cropped_images")
 
     def _build_cache(self):
-        pages = convert_from_path(pdf_file, 200)
-        for k, page in tqdm(enumerate(pages)):
+        os.makedirs(self.output_dir, exist_ok=True)
+        num_pages = pdfinfo_from_path(self.pdf_file)["Pages"]
+        for k in tqdm(range(num_pages)):
+            (page,) = convert_from_path(
+                self.pdf_file, 200, first_page=k + 1, last_page=k + 1
+            )
             self._process_page(k, page)
 
     def generate_cropboxes(self, page, x_step, y_step):
@@ -47,25 +57,95 @@ class CroppedImages(CachedData, Iterable[str]):
                 )
                 yield x, y, x1, y1
 
+    def window_views(self, page: Image.Image) -> tuple[NDArray, NDArray]:
+        return sliding_window_views(
+            np.asarray(page),
+            self.x_step_size_fun(page),
+            self.y_step_size_fun(page),
+            self.x_window_scale,
+            self.y_window_scale,
+        )
+
     def _process_page(self, k, page: PpmImageFile):
-        x_step = self.x_step_size_fun(page)
-        y_step = self.y_step_size_fun(page)
-        page_dir = f"{self.output_dir}/{Path(pdf_file).name}-{k}"
-        os.makedirs(page_dir, exist_ok=True)
-        for b in tqdm(self.generate_cropboxes(page, x_step, y_step)):
-            (x, y, x1, y1) = b
-            cropped = page.crop(b)
-            cropped.save(f"{page_dir}/cropped_{x}_{y}.jpg", "JPEG")
-        page.save(f"{self.output_dir}/{Path(pdf_file).name}-{k}.jpg", "JPEG")
+        page_name = f"{Path(self.pdf_file).name}-{k}"
+        if self.save_crops:
+            page_dir = f"{self.output_dir}/{page_name}"
+            os.makedirs(page_dir, exist_ok=True)
+            boxes, windows = self.window_views(page)
+            for (x, y, _, _), window in tqdm(
+                zip(boxes.reshape(-1, 4), _iter_windows(windows))
+            ):
+                Image.fromarray(window).save(f"{page_dir}/cropped_{x}_{y}.jpg", "JPEG")
+        page.save(f"{self.output_dir}/{page_name}.jpg", "JPEG")
+
+    def iter_page_windows(self) -> Iterator[tuple[str, NDArray, NDArray]]:
+        # windows are cut from the cached page-images, no crop-files needed
+        for p in sorted(Path(self.output_dir).glob("*.jpg")):
+            boxes, windows = self.window_views(Image.open(p))
+            yield str(p), boxes, windows
 
     def __iter__(self) -> Iterator[str]:
         for p in Path(self.output_dir).rglob("cropped*.jpg"):
             yield str(p)
 
 
+def sliding_window_views(
+    page: NDArray,
+    x_step: int,
+    y_step: int,
+    x_window_scale: int = 1,
+    y_window_scale: int = 3,
+) -> tuple[NDArray, NDArray]:
+    # same windows as CroppedImages.generate_cropboxes but as strided views into the page,
+    # boxes: (num_x, num_y, 4), windows: (num_x, num_y, height, width[, channels])
+    height, width = page.shape[:2]
+    window_height, window_width = y_step * y_window_scale, x_step * x_window_scale
+    xs = np.arange(0, width - x_step, x_step)
+    ys = np.arange(0, height - y_step, y_step)
+    # windows reaching beyond the page are zero-filled (as PIL's crop does), this
+    # pads the page once instead of copying every window
+    padding = [(0, window_height - y_step), (0, window_width - x_step)]
+    padded = np.pad(page, padding + [(0, 0)] * (page.ndim - 2))
+    windows = sliding_window_view(padded, (window_height, window_width), axis=(0, 1))
+    windows = np.moveaxis(windows, (-2, -1), (2, 3))  # channels last again
+    windows = windows[: len(ys) * y_step : y_step, : len(xs) * x_step : x_step]
+    windows = windows.swapaxes(0, 1)  # x-major like generate_cropboxes
+
+    x0, y0 = np.meshgrid(xs, ys, indexing="ij")
+    boxes = np.stack([x0, y0, x0 + window_width, y0 + window_height], axis=-1)
+    return boxes, windows
+
+
+def _iter_windows(windows: NDArray) -> Iterator[NDArray]:
+    for row in windows:
+        yield from row
+
+
+def rasterize_page_range(
+    pdf_file: str,
+    output_dir: str,
+    first_page: int,
+    last_page: int,
+    pages_per_chunk: int = 1,
+    dpi: int = 200,
+) -> int:
+    # pages are 1-based (as in pdftoppm), image-files are 0-based: <pdf-name>-<k>.jpg
+    # never more than pages_per_chunk pages are held in memory
+    name = Path(pdf_file).name
+    for first in range(first_page, last_page + 1, pages_per_chunk):
+        last = min(first + pages_per_chunk - 1, last_page)
+        pages = convert_from_path(pdf_file, dpi, first_page=first, last_page=last)
+        for k, page in enumerate(pages, start=first - 1):
+            page.save(f"{output_dir}/{name}-{k}.jpg", "JPEG")
+        del pages
+    return last_page - first_page + 1
+
+
 @dataclass
 class ImagesFromPdf(CachedData, Iterable[PrefixSuffix]):
     pdf_file: Union[_UNDEFINED, PrefixSuffix] = UNDEFINED
+    num_workers: int = field(default=1, repr=False)
+    pages_per_chunk: int = field(default=1, repr=False)
 
     cache_base: PrefixSuffix = field(
         default_factory=lambda: PrefixSuffix("cache_root", "pdf_page_images")
@@ -81,11 +161,33 @@ class ImagesFromPdf(CachedData, Iterable[PrefixSuffix]):
 
     def _build_cache(self):
         os.makedirs(self.output_dir, exist_ok=True)
-
-        pages = convert_from_path(str(self.pdf_file), 200)
-        for k, page in tqdm(enumerate(pages)):
-            page.save(
-                f"{self.output_dir}/{Path(str(self.pdf_file)).name}-{k}.jpg", "JPEG"
+        pdf_file = str(self.pdf_file)
+        num_pages = pdfinfo_from_path(pdf_file)["Pages"]
+        if self.num_workers > 1 and num_pages > 1:
+            # each worker gets a contiguous range of pages and writes them itself,
+            # so at most num_workers*pages_per_chunk pages are in memory
+            pages_per_worker = -(-num_pages // self.num_workers)
+            page_ranges = [
+                (first, min(first + pages_per_worker - 1, num_pages))
+                for first in range(1, num_pages + 1, pages_per_worker)
+            ]
+            with ProcessPoolExecutor(max_workers=len(page_ranges)) as executor:
+                futures = [
+                    executor.submit(
+                        rasterize_page_range,
+                        pdf_file,
+                        self.output_dir,
+                        first,
+                        last,
+                        self.pages_per_chunk,
+                    )
+                    for first, last in page_ranges
+                ]
+                for f in tqdm(futures, desc=f"rasterizing {num_pages} pages"):
+                    f.result()
+        else:
+            rasterize_page_range(
+                pdf_file, self.output_dir, 1, num_pages, self.pages_per_chunk
             )
 
     def __iter__(self) -> Iterator[PrefixSuffix]:
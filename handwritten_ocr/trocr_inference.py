@@ -1,8 +1,9 @@
 # https://github.com/NielsRogge/Transformers-Tutorials/blob/master/TrOCR/Evaluating_TrOCR_base_handwritten_on_the_IAM_test_set.ipynb
+import json
 import os
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Iterable, Iterator, Union, Optional
+from typing import Any, Callable, Iterator, Union, Optional
 
 import numpy as np
 import torch
@@ -11,9 +12,16 @@ from beartype import beartype
 from numpy.typing import NDArray
 from tqdm import tqdm
 from transformers import TrOCRProcessor, VisionEncoderDecoderModel
+from transformers.modeling_outputs import BaseModelOutputWithPooling
 
-from data_io.readwrite_files import read_jsonl
-from handwritten_ocr.craft_text_detection import CraftCroppedImages, CroppedImage
+from data_io.readwrite_files import read_json, read_lines, write_json
+from handwritten_ocr.craft_text_detection import (
+    CraftCroppedImages,
+    CroppedImage,
+    iter_crop_arrays,
+)
+from handwritten_ocr.embedding_store import EmbeddingStore, open_embedding_store
+from handwritten_ocr.inference_cache import InferenceCache, content_hash
 from handwritten_ocr.pdf_to_images import ImagesFromPdf
 from misc_utils.buildable import Buildable
 from misc_utils.cached_data_specific import CachedDataclasses
@@ -28,14 +36,14 @@ from misc_utils.processing_utils import iterable_to_batches
 
 @dataclass
 class EmbeddedImage(CroppedImage):
-    bucket_file: PrefixSuffix
-    bucket_index: int
+    store_dir: PrefixSuffix
+    row: int
     _array: Optional[NDArray] = field(init=True, default=None, repr=False)
 
     @property
     def array(self) -> NDArray:
         if self._array is None:
-            self._array = np.load(f"{self.bucket_file}")[self.bucket_index]
+            self._array = open_embedding_store(str(self.store_dir))[self.row]
         return self._array
 
     @beartype
@@ -43,36 +51,258 @@ class EmbeddedImage(CroppedImage):
         self._array = array
 
 
+ImageLike = Union[str, Image.Image, NDArray]
+
+
+def _to_rgb_image(image: ImageLike) -> Image.Image:
+    if isinstance(image, str):
+        image = Image.open(image)
+    elif isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    return image.convert("RGB")
+
+
+class _EncoderForExport(torch.nn.Module):
+    def __init__(self, encoder: torch.nn.Module):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, pixel_values: torch.Tensor):
+        o = self.encoder(pixel_values)
+        return o.last_hidden_state, o.pooler_output
+
+
+BACKENDS = ("torch", "int8", "onnx")
+
+
 @dataclass
 class OCRInferencer(Buildable):
     model_name: str = "microsoft/trocr-base-handwritten"
+    # torch: fp32, int8: dynamically quantized Linear-layers,
+    # onnx: encoder exported to and run by onnxruntime, decoder stays in torch
+    backend: str = "torch"
+    batch_size: int = 16
+    cache_dir: Optional[str] = field(default=None, repr=False)
+    cache_max_bytes: int = field(default=2**30, repr=False)
+    onnx_dir: str = field(default="onnx_models", repr=False)
 
     def _build_self(self) -> Any:
+        if self.backend not in BACKENDS:
+            raise ValueError(
+                f"unknown backend: {self.backend}, expected one of {BACKENDS}"
+            )
         self.processor = TrOCRProcessor.from_pretrained(self.model_name)
         self.model = VisionEncoderDecoderModel.from_pretrained(self.model_name)
         self.model.eval()
+        if self.backend == "int8":
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        elif self.backend == "onnx":
+            self.onnx_session = self._load_onnx_encoder()
+        self.cache = (
+            InferenceCache(self.cache_dir, self.cache_max_bytes)
+            if self.cache_dir is not None
+            else None
+        )
+
+    def _load_onnx_encoder(self):
+        import onnxruntime  # only needed for the onnx-backend
+
+        onnx_file = f"{self.onnx_dir}/{self.model_name.replace('/', '_')}-encoder.onnx"
+        if not os.path.isfile(onnx_file):
+            os.makedirs(self.onnx_dir, exist_ok=True)
+            size = self.processor.feature_extractor.size
+            torch.onnx.export(
+                _EncoderForExport(self.model.encoder),
+                torch.zeros((1, 3, size, size)),
+                onnx_file,
+                input_names=["pixel_values"],
+                output_names=["last_hidden_state", "pooler_output"],
+                dynamic_axes={
+                    name: {0: "batch"}
+                    for name in ["pixel_values", "last_hidden_state", "pooler_output"]
+                },
+                opset_version=13,
+            )
+        return onnxruntime.InferenceSession(
+            onnx_file, providers=["CPUExecutionProvider"]
+        )
+
+    def _encode(self, pixel_values: torch.Tensor) -> BaseModelOutputWithPooling:
+        if self.backend == "onnx":
+            last_hidden_state, pooler_output = self.onnx_session.run(
+                None, {"pixel_values": pixel_values.numpy()}
+            )
+            return BaseModelOutputWithPooling(
+                last_hidden_state=torch.from_numpy(last_hidden_state),
+                pooler_output=torch.from_numpy(pooler_output),
+            )
+        else:
+            return self.model.encoder(pixel_values)
 
     def ocr_file(self, file: str) -> str:
+        return self.ocr_batch([file])[0]
+
+    @beartype
+    def ocr_batch(
+        self, images: list[ImageLike], batch_size: Optional[int] = None
+    ) -> list[str]:
+        return self._ocr(images, "ocr", batch_size)
+
+    @beartype
+    def ocr_digits_batch(
+        self,
+        images: list[ImageLike],
+        extra_chars: str = "",
+        max_length: int = 6,
+        num_beams: int = 1,
+        batch_size: Optional[int] = None,
+    ) -> list[str]:
+        # for tally-fields: only tokens made of digits (and extra_chars) can be
+        # generated, short max_length + greedy/narrow beam keeps generation cheap
+        allowed_token_ids = self._allowed_token_ids(f"0123456789{extra_chars}")
+        return self._ocr(
+            images,
+            f"ocr-digits{extra_chars}-{max_length}-{num_beams}",
+            batch_size,
+            prefix_allowed_tokens_fn=lambda batch_id, input_ids: allowed_token_ids,
+            max_length=max_length,
+            num_beams=num_beams,
+            early_stopping=True,
+        )
+
+    def _allowed_token_ids(self, allowed_chars: str) -> list[int]:
+        if not hasattr(self, "_allowed_token_ids_cache"):
+            self._allowed_token_ids_cache = {}
+        if allowed_chars not in self._allowed_token_ids_cache:
+            tokenizer = self.processor.tokenizer
+
+            def is_allowed(token: str) -> bool:
+                token = token.strip()
+                return len(token) > 0 and all(c in allowed_chars for c in token)
+
+            ids = [
+                i for i in range(len(tokenizer)) if is_allowed(tokenizer.decode([i]))
+            ]
+            self._allowed_token_ids_cache[allowed_chars] = ids + [
+                tokenizer.eos_token_id
+            ]
+        return self._allowed_token_ids_cache[allowed_chars]
+
+    def _ocr(
+        self,
+        images: list[ImageLike],
+        task: str,
+        batch_size: Optional[int],
+        **generate_kwargs,
+    ) -> list[str]:
+        def ocr(pixel_values: torch.Tensor) -> list[tuple[NDArray]]:
+            texts = self._generate_texts(
+                pixel_values, self._encode(pixel_values), **generate_kwargs
+            )
+            return [(np.array(t),) for t in texts]
+
+        results = self._cached_inference(images, (task,), ocr, batch_size)
+        return [t.item() for (t,) in results]
+
+    def _generate_texts(
+        self,
+        pixel_values: torch.Tensor,
+        encoder_outputs: BaseModelOutputWithPooling,
+        **generate_kwargs,
+    ) -> list[str]:
         # https://huggingface.co/docs/transformers/v4.15.0/en/model_doc/trocr
-        pixel_values = self._pixel_values_from_file(file)
-        generated_ids = self.model.generate(pixel_values)
-        generated_text = self.processor.batch_decode(
-            generated_ids, skip_special_tokens=True
-        )[0]
-        return generated_text
-
-    def _pixel_values_from_file(self, file):
-        image = Image.open(file).convert("RGB")
-        pixel_values = self.processor(image, return_tensors="pt").pixel_values
-        return pixel_values
+        # passing encoder_outputs keeps generate from running the encoder again
+        generated_ids = self.model.generate(
+            pixel_values, encoder_outputs=encoder_outputs, **generate_kwargs
+        )
+        return self.processor.batch_decode(generated_ids, skip_special_tokens=True)
 
     @beartype
     def embedd_image(self, image_file: str) -> torch.Tensor:
-        with torch.no_grad():
-            pixel_values = self._pixel_values_from_file(image_file)
-            encoder_output = self.model.encoder(pixel_values)
-            embedding = encoder_output.pooler_output.squeeze()
-        return embedding
+        return self.embedd_batch([image_file])[0]
+
+    @beartype
+    def embedd_batch(
+        self, images: list[ImageLike], batch_size: Optional[int] = None
+    ) -> torch.Tensor:
+        def embedd(pixel_values: torch.Tensor) -> list[tuple[NDArray]]:
+            return [(e,) for e in self._encode(pixel_values).pooler_output.numpy()]
+
+        results = self._cached_inference(images, ("embedding",), embedd, batch_size)
+        return self._stack_embeddings([e for (e,) in results])
+
+    @beartype
+    def embedd_and_ocr_batch(
+        self, images: list[ImageLike], batch_size: Optional[int] = None
+    ) -> tuple[torch.Tensor, list[str]]:
+        # encoder runs once per batch, its hidden states feed both the pooled
+        # embedding and the decoder
+        def embedd_and_ocr(pixel_values: torch.Tensor) -> list[tuple[NDArray, NDArray]]:
+            encoder_outputs = self._encode(pixel_values)
+            texts = self._generate_texts(pixel_values, encoder_outputs)
+            return [
+                (e, np.array(t))
+                for e, t in zip(encoder_outputs.pooler_output.numpy(), texts)
+            ]
+
+        results = self._cached_inference(
+            images, ("embedding", "ocr"), embedd_and_ocr, batch_size
+        )
+        embeddings = self._stack_embeddings([e for e, _ in results])
+        return embeddings, [t.item() for _, t in results]
+
+    def _stack_embeddings(self, embeddings: list[NDArray]) -> torch.Tensor:
+        if len(embeddings) == 0:  # e.g. a page on which craft found no crops
+            return torch.zeros((0, self.model.config.encoder.hidden_size))
+        return torch.from_numpy(np.stack(embeddings))
+
+    def _cached_inference(
+        self,
+        images: list[ImageLike],
+        tasks: tuple[str, ...],
+        infer: Callable[[torch.Tensor], list[tuple[NDArray, ...]]],
+        batch_size: Optional[int],
+    ) -> list[tuple[NDArray, ...]]:
+        # identical images (blank boxes, printed form-furniture) are only computed
+        # once per call and, if there is a cache, once across calls;
+        # infer returns one array per task for every image
+        batch_size = self.batch_size if batch_size is None else batch_size
+        rgb_images = [_to_rgb_image(i) for i in images]
+        # hashing is cheap compared to the encoder, so keys are content-hashes
+        # even without a cache
+        keys = [
+            tuple(
+                content_hash(im, f"{self.model_name}/{self.backend}/{task}")
+                for task in tasks
+            )
+            for im in rgb_images
+        ]
+        key2result = {}
+        if self.cache is not None:
+            for key in set(keys):
+                cached = tuple(self.cache.get(k) for k in key)
+                if all(c is not None for c in cached):
+                    key2result[key] = cached
+
+        key2image = {k: im for k, im in zip(keys, rgb_images) if k not in key2result}
+        for batch in iterable_to_batches(
+            list(key2image.items()), batch_size=batch_size
+        ):
+            # processor resizes every image to the encoders fixed input-size,
+            # so the batch stacks without any extra padding
+            pixel_values = self.processor(
+                [im for _, im in batch], return_tensors="pt"
+            ).pixel_values
+            with torch.no_grad():
+                results = infer(pixel_values)
+            for (key, _), result in zip(batch, results):
+                key2result[key] = result
+                if self.cache is not None:
+                    for k, r in zip(key, result):
+                        self.cache.put(k, r)
+        return [key2result[k] for k in keys]
 
 
 @dataclass
@@ -80,7 +310,8 @@ class EmbeddedData(CachedDataclasses[EmbeddedImage]):
     name: Union[_UNDEFINED, str] = UNDEFINED
     images: Union[_UNDEFINED, CraftCroppedImages] = UNDEFINED
     inferencer: Union[_UNDEFINED, OCRInferencer] = UNDEFINED
-    bucket_size: int = 100
+    batch_size: int = 100
+    dtype: str = "float32"
 
     cache_base: PrefixSuffix = field(
         default_factory=lambda: PrefixSuffix("cache_root", "embeddings")
@@ -90,50 +321,83 @@ class EmbeddedData(CachedDataclasses[EmbeddedImage]):
     def data_folder(self):
         return self.prefix_cache_dir("data")
 
+    @property
+    def source_rows_json(self):
+        return self.prefix_cache_dir("source_rows.json")
+
+    @property
+    def store(self) -> EmbeddingStore:
+        return open_embedding_store(self.data_folder, dtype=self.dtype)
+
     def generate_dataclasses_to_cache(self) -> Iterator[EmbeddedImage]:
+        # rows left by an interrupted build would shift the row-numbering
+        self.store.clear()
         os.makedirs(self.data_folder, exist_ok=True)
         yield from self._dump_batches()
 
     def _dump_batches(self):
-        g = (
-            (
-                im,
-                self.inferencer.embedd_image(str(im.cropped_image_file))
-                .detach()
-                .numpy(),
-            )
-            for im in tqdm(self.images, desc="embedding images")
-        )
-
-        for k, bucket in enumerate(iterable_to_batches(g, batch_size=self.bucket_size)):
-            bucket: list[tuple[CroppedImage, NDArray]]
-            concat_array = np.concatenate([a for i, a in bucket])
-            bucket_file_name = f"bucket-{k}.npy"
-            bucket_file = f"{self.data_folder}/{bucket_file_name}"
-            np.save(bucket_file, concat_array)
+        store_dir = self.cache_dir.from_str_same_prefix(self.data_folder)
+        source_rows: dict[str, list[list[int]]] = {}
+        crops = tqdm(iter_crop_arrays(self.images), desc="embedding images")
+        for batch in iterable_to_batches(crops, batch_size=self.batch_size):
+            batch: list[tuple[CroppedImage, NDArray]]
+            arrays = self.inferencer.embedd_batch([a for _, a in batch]).numpy()
+            rows = self.store.append(arrays)
+            for row, (i, _) in zip(rows, batch):
+                ranges = source_rows.setdefault(source_pdf_name(i), [])
+                if len(ranges) > 0 and ranges[-1][1] == row:
+                    ranges[-1][1] = row + 1
+                else:
+                    ranges.append([row, row + 1])
             yield from [
                 EmbeddedImage(
                     image_file=i.image_file,
                     cropped_image_file=i.cropped_image_file,
                     box=i.box,
-                    bucket_file=self.cache_dir.from_str_same_prefix(bucket_file),
-                    bucket_index=bidx,
+                    poly=i.poly,
+                    store_dir=store_dir,
+                    row=row,
                 )
-                for bidx, (i, a) in enumerate(bucket)
+                for row, (i, _) in zip(rows, batch)
             ]
 
+        write_json(self.source_rows_json, source_rows)
+
     def __iter__(self) -> Iterator[EmbeddedImage]:
-        g: Iterable[EmbeddedImage] = (
-            decode_dataclass(d) for d in read_jsonl(self.jsonl_file)
-        )
-        bucketfile2datum = {d.bucket_file: d for d in g}
-        for p in Path(self.data_folder).glob("*.npy"):
-            batch_array = np.load(str(p))
-            for k, a in enumerate(batch_array):
-                datum: EmbeddedImage = bucketfile2datum[p.name]
-                assert k == datum.bucket_index
-                datum.set_array(a)
-                yield datum
+        yield from self.iter_rows()
+
+    def rows_of_pdf(self, pdf_name: str) -> list[int]:
+        return [
+            row
+            for start, stop in read_json(self.source_rows_json).get(pdf_name, [])
+            for row in range(start, stop)
+        ]
+
+    def iter_rows(
+        self, rows: Optional[slice] = None, pdf_name: Optional[str] = None
+    ) -> Iterator[EmbeddedImage]:
+        # one pass over the jsonl in row-order, jsonl-line k holds row k, so only
+        # the selected lines get decoded, arrays are views into the memmapped store
+        wanted = set(range(len(self.store))[rows]) if rows is not None else None
+        if pdf_name is not None:
+            pdf_rows = set(self.rows_of_pdf(pdf_name))
+            wanted = pdf_rows if wanted is None else wanted & pdf_rows
+        matrix = self.store.matrix
+        last_row = max(wanted, default=-1) if wanted is not None else len(matrix)
+        for row, line in enumerate(read_lines(self.jsonl_file)):
+            if row > last_row:
+                break
+            if wanted is not None and row not in wanted:
+                continue
+            datum: EmbeddedImage = decode_dataclass(json.loads(line))
+            assert datum.row == row, f"{datum.row=} != {row=}"
+            datum.set_array(matrix[row])
+            yield datum
+
+
+def source_pdf_name(im: CroppedImage) -> str:
+    # page-images are named <pdf-name>-<page-index>.jpg (see ImagesFromPdf)
+    return Path(str(im.image_file)).name.rsplit("-", 1)[0]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+import subprocess
+import xml.etree.ElementTree as ET
+from io import BytesIO
+
+from data_io.readwrite_files import read_file
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]  # strips the xhtml-namespace
+
+
+def parse_bbox_xhtml(xhtml: bytes) -> list[dict]:
+    # parses the output of poppler's "pdftotext -bbox" into one record per page:
+    # {"page": k, "width": w, "height": h, "words": [{"text": t, "box": [x0, y0, x1, y1]}]}
+    pages = []
+    for event, e in ET.iterparse(BytesIO(xhtml), events=("start", "end")):
+        name = _local_name(e.tag)
+        if event == "start" and name == "page":
+            pages.append(
+                {
+                    "page": len(pages),
+                    "width": float(e.attrib["width"]),
+                    "height": float(e.attrib["height"]),
+                    "words": [],
+                }
+            )
+        elif event == "end" and name == "word":
+            box = [float(e.attrib[k]) for k in ["xMin", "yMin", "xMax", "yMax"]]
+            pages[-1]["words"].append({"text": e.text or "", "box": box})
+        elif event == "end" and name == "page":
+            e.clear()
+    return pages
+
+
+def extract_word_boxes(pdf_file: str) -> list[dict]:
+    # reads the (ocrmypdf-generated) text-layer directly via poppler, which is
+    # installed anyhow for pdf2image, no pdf->html round-trip through pdfminer
+    xhtml = subprocess.run(
+        ["pdftotext", "-bbox", pdf_file, "-"], check=True, capture_output=True
+    ).stdout
+    return parse_bbox_xhtml(xhtml)
+
+
+def read_sidecar_pages(sidecar_file: str) -> list[str]:
+    # ocrmypdf's sidecar separates pages by form-feeds
+    return read_file(sidecar_file).split("\f")
@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import os
+import sys
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+from tqdm import tqdm
+
+sys.path.append(".")
+
+from data_io.readwrite_files import read_jsonl, write_jsonl
+from scraping_forms.scrape_with_beautifulsoup import is_complete_pdf
+
+
+@dataclass
+class HostRateLimiter:
+    # spaces out requests to one host, shared by all download-tasks
+    min_interval: float
+    _next: float = field(default=0.0, init=False, repr=False)
+    _lock: asyncio.Lock = field(default_factory=asyncio.Lock, init=False, repr=False)
+
+    async def wait(self):
+        async with self._lock:
+            wait_time = self._next - monotonic()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            self._next = monotonic() + self.min_interval
+
+
+def expected_total_size(response: httpx.Response) -> Optional[int]:
+    # size of the complete remote file, None if the server does not tell
+    if response.status_code == 206:
+        total = response.headers.get("content-range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get("content-length", "")
+    return int(length) if length.isdigit() else None
+
+
+def sha256_of_file(file: str) -> str:
+    h = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@dataclass
+class AsyncPdfDownloader:
+    # downloads the pdf_url/pdf_file_full rows of a selection_states.jsonl-manifest
+    # (see NestedDropDowns, HttpDropDownCrawler) into data_dir;
+    # files are streamed into <pdf_file_full>.part, interrupted downloads are
+    # resumed via http-range-requests and only complete files (size as announced by
+    # the server and ending with %%EOF) are renamed to their final name;
+    # checksums.jsonl and failures.jsonl are written to state_dir
+    manifest_jsonl: str
+    data_dir: str
+    state_dir: str
+    max_concurrency: int = 16
+    max_requests_per_second_per_host: float = 2.0
+    num_retries: int = 3
+    timeout: float = 60.0
+
+    @property
+    def checksums_jsonl(self):
+        return f"{self.state_dir}/checksums.jsonl"
+
+    @property
+    def failures_jsonl(self):
+        return f"{self.state_dir}/failures.jsonl"
+
+    def _todo(self) -> list[dict]:
+        already_downloaded = {
+            e.name
+            for e in os.scandir(self.data_dir)
+            if e.name.endswith(".pdf") and is_complete_pdf(e.path)
+        }
+        todo = {
+            d["pdf_file_full"]: d
+            for d in read_jsonl(self.manifest_jsonl)
+            if "pdf_url" in d and d["pdf_file_full"] not in already_downloaded
+        }
+        return list(todo.values())
+
+    def run(self):
+        os.makedirs(self.data_dir, exist_ok=True)
+        os.makedirs(self.state_dir, exist_ok=True)
+        todo = self._todo()
+        print(f"{len(todo)} pdfs still TODO")
+        asyncio.run(self._run(todo))
+
+    async def _run(self, todo: list[dict]):
+        self._rate_limiters: dict[str, HostRateLimiter] = {}
+        self._pbar = tqdm(total=len(todo), desc="downloading pdfs")
+        self._num_failed = 0
+        queue = asyncio.Queue()
+        for d in todo:
+            queue.put_nowait(d)
+        limits = httpx.Limits(
+            max_connections=self.max_concurrency,
+            max_keepalive_connections=self.max_concurrency,
+        )
+        async with httpx.AsyncClient(
+            limits=limits, timeout=self.timeout, follow_redirects=True
+        ) as client:
+            workers = [
+                asyncio.create_task(self._worker(client, queue))
+                for _ in range(self.max_concurrency)
+            ]
+            await asyncio.gather(*workers)
+        self._pbar.close()
+
+    async def _worker(self, client: httpx.AsyncClient, queue: asyncio.Queue):
+        while not queue.empty():
+            d = queue.get_nowait()
+            for k in range(self.num_retries):
+                try:
+                    await self._download(client, d)
+                    break
+                except Exception as e:
+                    if k < self.num_retries - 1:
+                        await asyncio.sleep(2**k)
+                        continue
+                    self._num_failed += 1
+                    write_jsonl(
+                        self.failures_jsonl,
+                        [{"pdf_url": d["pdf_url"], "error": repr(e)}],
+                        mode="ab",
+                    )
+            self._pbar.update(1)
+            self._pbar.set_postfix(failed=self._num_failed)
+
+    def _rate_limiter(self, url: str) -> HostRateLimiter:
+        host = urlsplit(url).netloc
+        if host not in self._rate_limiters:
+            self._rate_limiters[host] = HostRateLimiter(
+                1.0 / self.max_requests_per_second_per_host
+            )
+        return self._rate_limiters[host]
+
+    async def _download(self, client: httpx.AsyncClient, d: dict):
+        file = f"{self.data_dir}/{d['pdf_file_full']}"
+        part_file = f"{file}.part"
+        offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+        # identity-encoding: byte-offsets and content-length refer to the file itself
+        headers = {"Accept-Encoding": "identity"}
+        if offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+
+        await self._rate_limiter(d["pdf_url"]).wait()
+        async with client.stream("GET", d["pdf_url"], headers=headers) as response:
+            if response.status_code == 416:
+                # part-file is not a prefix of the remote file (e.g. larger), refetch
+                os.remove(part_file)
+                return await self._download(client, d)
+            response.raise_for_status()
+            expected_size = expected_total_size(response)
+            resumed = response.status_code == 206
+            with open(part_file, "ab" if resumed else "wb") as f:
+                async for chunk in response.aiter_raw(2**16):
+                    f.write(chunk)
+
+        size = os.path.getsize(part_file)
+        if expected_size is not None and size != expected_size:
+            if size > expected_size:
+                os.remove(part_file)
+            raise ValueError(f"got {size} of {expected_size} bytes for {d['pdf_url']}")
+        if not is_complete_pdf(part_file):
+            os.remove(part_file)
+            raise ValueError(f"not a (complete) pdf: {d['pdf_url']}")
+
+        sha256 = sha256_of_file(part_file)
+        expected: Optional[str] = d.get("sha256")
+        if expected is not None and sha256 != expected:
+            os.remove(part_file)
+            raise ValueError(f"checksum mismatch for {d['pdf_url']}")
+        os.replace(part_file, file)
+        write_jsonl(
+            self.checksums_jsonl,
+            [
+                {
+                    "pdf_file_full": d["pdf_file_full"],
+                    "pdf_url": d["pdf_url"],
+                    "sha256": sha256,
+                    "size": size,
+                }
+            ],
+            mode="ab",
+        )
+
+
+if __name__ == "__main__":
+    data_path = os.environ["DATA_PATH"]
+    AsyncPdfDownloader(
+        manifest_jsonl=f"{data_path}/e14_cong_2018/downloads/selection_states.jsonl",
+        data_dir=f"{data_path}/e14_cong_2018/data",
+        state_dir=f"{data_path}/e14_cong_2018/async_downloads",
+    ).run()
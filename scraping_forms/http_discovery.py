@@ -0,0 +1,290 @@
+import asyncio
+import hashlib
+import os
+import sys
+from dataclasses import dataclass, field, replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import urljoin, urlsplit
+
+import httpx
+from bs4 import BeautifulSoup
+from tqdm import tqdm
+
+sys.path.append(".")
+
+from data_io.readwrite_files import read_json, read_jsonl, write_jsonl
+from scraping_forms.pdf_files import pdf_file_names
+
+if TYPE_CHECKING:  # selenium is only needed for the fallback
+    from scraping_forms.nested_dropdowns import NestedDropDowns
+
+
+@dataclass
+class HttpLevel:
+    # url_template is formatted with base_url and the option-values of all levels
+    # above, e.g. "{base_url}/some/endpoint?dep={departamento}"; the endpoints of
+    # the registraduria-sites must be looked up in the browser's network-tab
+    name: str
+    url_template: str
+    response_format: str = "html"  # "html": <option>-tags, "json": list of objects
+    json_value_key: str = "value"
+    json_text_key: str = "text"
+
+
+@dataclass
+class HttpPdfLinks:
+    url_template: str
+    link_class: Optional[str] = None  # e.g. "btnPdf", None means all non-js links
+
+
+def parse_options(level: HttpLevel, response: httpx.Response) -> list[tuple[str, str]]:
+    if level.response_format == "json":
+        return [
+            (str(o[level.json_value_key]), str(o[level.json_text_key]))
+            for o in response.json()
+        ]
+    soup = BeautifulSoup(response.text, features="html.parser")
+    return [
+        (o.attrs.get("value", o.text), o.text.strip()) for o in soup.find_all("option")
+    ]
+
+
+def parse_pdf_links(
+    links: HttpPdfLinks, response: httpx.Response, base_url: str
+) -> list[str]:
+    soup = BeautifulSoup(response.text, features="html.parser")
+    anchors = (
+        soup.find_all(class_=links.link_class)
+        if links.link_class is not None
+        else soup.find_all("a")
+    )
+    return [
+        urljoin(f"{base_url}/", e.attrs["href"])
+        for e in anchors
+        if "href" in e.attrs and "javascript" not in e.attrs["href"]
+    ]
+
+
+@dataclass
+class HttpDropDownCrawler:
+    # enumerates the same selection-tree as NestedDropDowns but with plain
+    # http-requests over one pooled keep-alive client; writes a manifest in the
+    # schema of selection_states.jsonl, leafs that fail over http are written to
+    # failures.jsonl and can be re-crawled with selenium (see selenium_fallback)
+    base_url: str
+    levels: list[HttpLevel]
+    pdf_links: HttpPdfLinks
+    output_dir: str
+    option_blacklist: list[str] = field(default_factory=lambda: ["SELECCIONE"])
+    max_connections: int = 8
+    num_retries: int = 3
+    timeout: float = 30.0
+    record_dir: Optional[str] = None  # to build a RecordedResponsesServer from
+
+    @property
+    def manifest_jsonl(self):
+        return f"{self.output_dir}/selection_states.jsonl"
+
+    @property
+    def failures_jsonl(self):
+        return f"{self.output_dir}/failures.jsonl"
+
+    def run(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._done_leafs = (
+            {
+                tuple(d["selection_path"])
+                for d in read_jsonl(self.manifest_jsonl)
+                if "num_pdfs" in d
+            }
+            if os.path.isfile(self.manifest_jsonl)
+            else set()
+        )
+        print(f"already got {len(self._done_leafs)} leafs")
+        asyncio.run(self._run())
+
+    async def _run(self):
+        self._semaphore = asyncio.Semaphore(self.max_connections)
+        self._pbar = tqdm(desc="http-discovery (leafs)")
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections,
+        )
+        async with httpx.AsyncClient(
+            limits=limits, timeout=self.timeout, follow_redirects=True
+        ) as client:
+            await self._expand(client, 0, {}, [])
+        self._pbar.close()
+
+    async def _get(self, client: httpx.AsyncClient, url: str) -> httpx.Response:
+        for k in range(self.num_retries):
+            try:
+                async with self._semaphore:
+                    response = await client.get(url)
+                response.raise_for_status()
+                if self.record_dir is not None:
+                    self._record(url, response)
+                return response
+            except httpx.HTTPError:
+                if k == self.num_retries - 1:
+                    raise
+                await asyncio.sleep(2**k)
+
+    async def _expand(
+        self,
+        client: httpx.AsyncClient,
+        depth: int,
+        values: dict[str, str],
+        selection_path: list[str],
+    ):
+        try:
+            if depth == len(self.levels):
+                await self._process_leaf(client, values, selection_path)
+                return
+            level = self.levels[depth]
+            url = level.url_template.format(base_url=self.base_url, **values)
+            options = parse_options(level, await self._get(client, url))
+        except Exception as e:
+            write_jsonl(
+                self.failures_jsonl,
+                [{"selection_path": selection_path, "error": repr(e)}],
+                mode="ab",
+            )
+            return
+        await asyncio.gather(
+            *[
+                self._expand(
+                    client,
+                    depth + 1,
+                    values | {level.name: value},
+                    selection_path + [text],
+                )
+                for value, text in options
+                if text not in self.option_blacklist
+            ]
+        )
+
+    async def _process_leaf(
+        self,
+        client: httpx.AsyncClient,
+        values: dict[str, str],
+        selection_path: list[str],
+    ):
+        if tuple(selection_path) in self._done_leafs:
+            return
+        url = self.pdf_links.url_template.format(base_url=self.base_url, **values)
+        pdf_urls = parse_pdf_links(
+            self.pdf_links, await self._get(client, url), self.base_url
+        )
+        rows = []
+        for pdf_url in pdf_urls:
+            pdf_file, pdf_file_full = pdf_file_names(pdf_url, self.base_url)
+            rows.append(
+                {
+                    "selection_path": selection_path,
+                    "pdf_file": pdf_file,
+                    "pdf_file_full": pdf_file_full,
+                    "pdf_url": pdf_url,
+                }
+            )
+        rows.append({"selection_path": selection_path, "num_pdfs": len(pdf_urls)})
+        write_jsonl(self.manifest_jsonl, rows, mode="ab")
+        self._pbar.update(1)
+
+    def _record(self, url: str, response: httpx.Response):
+        os.makedirs(self.record_dir, exist_ok=True)
+        split = urlsplit(url)
+        path = f"{split.path}?{split.query}" if split.query else split.path
+        file = hashlib.sha1(path.encode("utf-8")).hexdigest()
+        with open(f"{self.record_dir}/{file}", "wb") as f:
+            f.write(response.content)
+        write_jsonl(
+            f"{self.record_dir}/index.jsonl",
+            [
+                {
+                    "path": path,
+                    "file": file,
+                    "content_type": response.headers.get("content-type", ""),
+                }
+            ],
+            mode="ab",
+        )
+
+
+def selenium_fallback(scraper: "NestedDropDowns", failures_jsonl: str):
+    # re-crawls the subtrees that failed over http with the browser-based scraper,
+    # one pass per failed subtree restricted to its selection-path
+    from selenium_scraping.selenium_util import ChromeDriver  # only needed here
+
+    failed_paths = sorted(
+        {tuple(d["selection_path"]) for d in read_jsonl(failures_jsonl)}
+    )
+    for path in failed_paths:
+        restricted = replace(
+            scraper,
+            selections=[
+                replace(s, only_options=[path[k]] if k < len(path) else None)
+                for k, s in enumerate(scraper.selections)
+            ],
+        )
+        try:
+            with ChromeDriver(
+                restricted.download_path, headless=restricted.headless
+            ) as wd:
+                restricted._run(wd)
+        except Exception as e:
+            print(f"selenium-fallback failed for {path}: {e}")
+
+
+class RecordedResponsesServer(ThreadingHTTPServer):
+    # local stand-in for the registraduria-site, serves the responses recorded by
+    # HttpDropDownCrawler(record_dir=...) so the crawler can be run against it
+    def __init__(self, record_dir: str, port: int = 0):
+        self.record_dir = record_dir
+        self.responses = {
+            d["path"]: (d["file"], d["content_type"])
+            for d in read_jsonl(f"{record_dir}/index.jsonl")
+        }
+        super().__init__(("127.0.0.1", port), _RecordedResponseHandler)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "RecordedResponsesServer":
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _RecordedResponseHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in self.server.responses:
+            self.send_error(404)
+            return
+        file, content_type = self.server.responses[self.path]
+        with open(f"{self.server.record_dir}/{file}", "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    # python scraping_forms/http_discovery.py <config.json> [<recorded-responses-dir>]
+    # config: {"base_url": ..., "output_dir": ..., "levels": [{"name": ..., "url_template": ...}, ...],
+    #          "pdf_links": {"url_template": ..., "link_class": ...}}
+    config = read_json(sys.argv[1])
+    server = RecordedResponsesServer(sys.argv[2]).start() if len(sys.argv) > 2 else None
+    HttpDropDownCrawler(
+        base_url=server.base_url if server is not None else config["base_url"],
+        levels=[HttpLevel(**d) for d in config["levels"]],
+        pdf_links=HttpPdfLinks(**config["pdf_links"]),
+        output_dir=config["output_dir"],
+    ).run()
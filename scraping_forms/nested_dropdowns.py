@@ -4,51 +4,149 @@ import os
 import shutil
 import sys
 import traceback
+import zlib
 from abc import abstractmethod
 from dataclasses import dataclass, field
 from pathlib import Path
-from time import sleep
-from typing import Optional, List
+from time import sleep, time
+from typing import ClassVar, Optional, List
 
 from beartype import beartype
 from data_io.readwrite_files import read_json, write_json, write_jsonl
 from misc_utils.beartypes import NeList
+from scraping_forms.pdf_files import pdf_file_names
+from selenium.common.exceptions import (
+    StaleElementReferenceException,
+    TimeoutException,
+)
 from selenium.webdriver.common.by import By
 from selenium.webdriver.remote.webdriver import WebDriver
 from selenium.webdriver.remote.webelement import WebElement
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 from selenium_scraping.selenium_util import ChromeDriver, retry
 
 
-@beartype
-def get_options(wd: WebDriver, xpath: str) -> NeList:
-    element: WebElement = wd.find_element(by=By.XPATH, value=xpath)
-    element.click()
-    sleep(0.1)
-    options = element.find_elements_by_tag_name("option")
-    return options
-
-
 @dataclass
 class DropDownSelection:
     name: str
     xpath: str
     stop: Optional[int] = None
     start_option: Optional[str] = None
+    # (worker_index, num_workers): only options hashing to worker_index are visited
+    partition: Optional[tuple[int, int]] = None
+    only_options: Optional[list[str]] = None  # to revisit single subtrees
+
+    def in_partition(self, option: str) -> bool:
+        if self.only_options is not None and option not in self.only_options:
+            return False
+        if self.partition is None:
+            return True
+        worker_index, num_workers = self.partition
+        # crc32 instead of hash(), which is salted differently in every process
+        return zlib.crc32(option.encode("utf-8")) % num_workers == worker_index
+
+
+@dataclass
+class RateLimiter:
+    min_interval: float = 0.0  # seconds between two requests
+    _last: float = field(default=0.0, init=False, repr=False)
+
+    def wait(self):
+        wait_time = self._last + self.min_interval - time()
+        if wait_time > 0:
+            sleep(wait_time)
+        self._last = time()
+
+
+@dataclass
+class AdaptiveWait:
+    # waits for dom-conditions instead of sleeping, the timeout per level follows
+    # the observed latencies (moving average) and is doubled after every timeout of
+    # a required condition; optional ones (do_raise=False) may legitimately never hold
+    min_timeout: float = 2.0
+    max_timeout: float = 60.0
+    latencies_jsonl: Optional[str] = None
+    _mean_latency: dict = field(default_factory=dict, init=False, repr=False)
+    _backoff: dict = field(default_factory=dict, init=False, repr=False)
+
+    def timeout(self, level: str) -> float:
+        timeout = 4 * self._mean_latency.get(level, 0.0) * self._backoff.get(level, 1)
+        return min(max(timeout, self.min_timeout), self.max_timeout)
+
+    def until(self, wd: WebDriver, level: str, condition, do_raise: bool = True):
+        start = time()
+        try:
+            result = WebDriverWait(wd, self.timeout(level), poll_frequency=0.05).until(
+                condition
+            )
+            timed_out = False
+        except TimeoutException:
+            result, timed_out = None, True
+        seconds = time() - start
+        if timed_out and do_raise:
+            self._backoff[level] = min(2 * self._backoff.get(level, 1), 16)
+        elif not timed_out:
+            mean = self._mean_latency.get(level, seconds)
+            self._mean_latency[level] = 0.9 * mean + 0.1 * seconds
+            self._backoff[level] = 1
+        if self.latencies_jsonl is not None:
+            write_jsonl(
+                self.latencies_jsonl,
+                [
+                    {
+                        "level": level,
+                        "seconds": round(seconds, 3),
+                        "timed_out": timed_out,
+                    }
+                ],
+                mode="ab",
+            )
+        if timed_out and do_raise:
+            raise TimeoutException(f"waiting for {level} timed out")
+        return result
+
+
+@beartype
+def get_options(
+    wd: WebDriver, sel: DropDownSelection, waiter: AdaptiveWait, blacklist: list[str]
+) -> NeList:
+    element: WebElement = waiter.until(
+        wd, sel.name, EC.element_to_be_clickable((By.XPATH, sel.xpath))
+    )
+    element.click()
+
+    def options_populated(_):
+        options = element.find_elements(By.TAG_NAME, "option")
+        return options if any(o.text not in blacklist for o in options) else False
+
+    return waiter.until(wd, f"{sel.name}-options", options_populated)
 
 
 @beartype
 def get_click_option(
-    wd: WebDriver, sel: DropDownSelection, option: str, blacklist: list[str]
+    wd: WebDriver,
+    sel: DropDownSelection,
+    option: str,
+    blacklist: list[str],
+    waiter: AdaptiveWait,
 ):
-    option_elements = get_options(wd, sel.xpath)
+    option_elements = get_options(wd, sel, waiter, blacklist)
     options_texts = [e.text for e in option_elements]
     # print(f"{sel.name=} searching for {option} in {options_texts}")
     failed = True
-    sleep(0.3)
     for e, ot in zip(option_elements, options_texts):
         if ot == option:
             e.click()
             e.click()
+
+            def is_selected(_):
+                try:
+                    return e.is_selected()
+                except StaleElementReferenceException:
+                    return True  # site already re-rendered the dropdown
+
+            waiter.until(wd, f"{sel.name}-selected", is_selected)
             failed = False
             break
     else:
@@ -74,10 +172,15 @@ def _calc_start(options: NeList[str], sel: DropDownSelection):
 
 @beartype
 def get_options_and_start(
-    wd: WebDriver, sel: DropDownSelection, option_blacklist: list[str]
+    wd: WebDriver,
+    sel: DropDownSelection,
+    option_blacklist: list[str],
+    waiter: AdaptiveWait,
 ) -> tuple[list[str], int]:
     options = [
-        o.text for o in get_options(wd, sel.xpath) if o.text not in option_blacklist
+        o.text
+        for o in get_options(wd, sel, waiter, option_blacklist)
+        if o.text not in option_blacklist
     ]
     assert len(options) > 0
 
@@ -96,15 +199,33 @@ class NestedDropDowns:
     data_dir: str
     selections: NeList[DropDownSelection]
     option_blacklist: List[str] = field(default_factory=lambda: ["SELECCIONE"])
-    before_pdfs_wait: float = 0.5
-    between_two_pdfs_wait_time: float = 1.0  # seconds
+    between_two_pdfs_wait_time: float = 1.0  # seconds, minimum time between two pdfs
     headless: bool = True
     state: Optional[dict] = None
+    # shared by all workers of a ParallelNestedDropDowns, defaults to download_path
+    progress_jsonl: Optional[str] = None
+    min_seconds_between_pdfs: float = 0.0
+    # elements that are replaced once the pdf-links of a new leaf are rendered
+    pdf_links_locator: ClassVar[Optional[tuple[str, str]]] = None
+
+    def __post_init__(self):
+        self.rate_limiter = RateLimiter(
+            max(self.between_two_pdfs_wait_time, self.min_seconds_between_pdfs)
+        )
+        self.waiter = AdaptiveWait(
+            latencies_jsonl=f"{self.download_path}/latencies.jsonl"
+        )
 
     @property
     def state_json(self):
         return f"{self.download_path}/state.json"
 
+    @property
+    def selection_states_jsonl(self):
+        if self.progress_jsonl is not None:
+            return self.progress_jsonl
+        return f"{self.download_path}/selection_states.jsonl"
+
     def _set_start_state(self):
         os.makedirs(self.download_path, exist_ok=True)
         os.makedirs(self.data_dir, exist_ok=True)
@@ -163,18 +284,37 @@ class NestedDropDowns:
     def get_pdf_urls(self) -> List[str]:
         raise NotImplemented
 
+    def _first_element(self, by: str, value: str) -> Optional[WebElement]:
+        elements = self.wd.find_elements(by, value)
+        return elements[0] if len(elements) > 0 else None
+
+    def _refresh_probe(
+        self, selections: List[DropDownSelection]
+    ) -> Optional[WebElement]:
+        # an element that gets replaced once the site reacted to the next click
+        if len(selections) > 1:
+            return self._first_element(By.XPATH, f"{selections[1].xpath}/option")
+        elif self.pdf_links_locator is not None:
+            return self._first_element(*self.pdf_links_locator)
+        else:
+            return None
+
+    def _wait_for_refresh(self, level: str, probe: Optional[WebElement]):
+        if probe is not None:
+            self.waiter.until(self.wd, level, EC.staleness_of(probe), do_raise=False)
+
     @beartype
     def _recurse_through_dropdown_tree(
         self, selections: List[DropDownSelection], selection_path: List[str]
     ):
         sys.stdout.write(f"\r{selection_path=}")
         sel = selections[0]
-        step_in_selection_wait = 1.0
-        sleep(step_in_selection_wait)
 
         options, start = retry(
-            lambda: get_options_and_start(self.wd, sel, self.option_blacklist),
-            wait_time=0.5,
+            lambda: get_options_and_start(
+                self.wd, sel, self.option_blacklist, self.waiter
+            ),
+            wait_time=0.1,
             num_retries=4,
             increase_wait_time=True,
             do_raise=False,
@@ -182,31 +322,42 @@ class NestedDropDowns:
             fail_message="failed to get options",
         )
         stop = len(options) if sel.stop is None else sel.stop
-        todo_options = [options[k] for k in range(start, stop)]
+        todo_options = [
+            options[k] for k in range(start, stop) if sel.in_partition(options[k])
+        ]
         done_options = []
         err = None
         while len(todo_options) > 0:
             option = todo_options[0]
             try:
+                probe = self._refresh_probe(selections)
                 for _ in range(1):
                     failed, options = retry(
                         lambda: get_click_option(
-                            self.wd, sel, option, self.option_blacklist
+                            self.wd, sel, option, self.option_blacklist, self.waiter
                         ),
-                        wait_time=0.5,
+                        wait_time=0.1,
                         num_retries=3,
                         increase_wait_time=True,
                         fail_message="failed to get+click option",
                         do_raise=True,
                     )
                 if failed:
-                    todo_options = [o for o in options if o not in done_options]
+                    todo_options = [
+                        o
+                        for o in options
+                        if o not in done_options and sel.in_partition(o)
+                    ]
                 else:
                     todo_options.pop(todo_options.index(option))
                     done_options.append(option)
                     selection_path.append(option)
 
                     is_last = len(selections) == 1
+                    self._wait_for_refresh(
+                        "pdf-links" if is_last else f"{selections[1].name}-refresh",
+                        probe,
+                    )
                     if not is_last:
                         retry(
                             lambda: self._recurse_through_dropdown_tree(
@@ -251,7 +402,6 @@ class NestedDropDowns:
     @beartype
     def _process_selection_leaf(self, selection_path: NeList[str]):
         sys.stdout.write(f"\r{selection_path=}")
-        sleep(self.before_pdfs_wait)
         num_pdfs = 0
         num_pdfs_downloaded = 0
         selection_path_copy = selection_path.copy()
@@ -259,10 +409,7 @@ class NestedDropDowns:
         try:
             pdfs = self.get_pdf_urls()
             for pdf_url in pdfs:
-                pdf_file_full = pdf_url.replace(f"{self.base_url}/", "").replace(
-                    "/", "_"
-                )
-                pdf_file = pdf_url.split("/")[-1]
+                pdf_file, pdf_file_full = pdf_file_names(pdf_url, self.base_url)
                 self.to_be_moved[pdf_file] = pdf_file_full
                 num_pdfs += 1
                 download_in_process = os.path.isfile(
@@ -271,10 +418,11 @@ class NestedDropDowns:
                 already_in_data_dir = os.path.isfile(f"{self.data_dir}/{pdf_file_full}")
                 already_got_it = already_in_data_dir or download_in_process
                 if not already_got_it:
+                    self.rate_limiter.wait()
                     self.wd.get(pdf_url)
                     num_pdfs_downloaded += 1
                     write_jsonl(
-                        f"{self.download_path}/selection_states.jsonl",
+                        self.selection_states_jsonl,
                         [
                             {
                                 "selection_path": selection_path,
@@ -285,13 +433,21 @@ class NestedDropDowns:
                         ],
                         mode="ab",
                     )
-                    sleep(self.between_two_pdfs_wait_time)
+                    self.waiter.until(
+                        self.wd,
+                        "download-started",
+                        lambda _: any(
+                            os.path.isfile(f"{self.download_path}/{f}")
+                            for f in [pdf_file, f"{pdf_file}.crdownload"]
+                        ),
+                        do_raise=False,
+                    )
                 else:
                     sys.stdout.write(f"\ralready got {pdf_file}")
 
         finally:
             write_jsonl(
-                f"{self.download_path}/selection_states.jsonl",
+                self.selection_states_jsonl,
                 [
                     {
                         "selection_path": selection_path,
@@ -0,0 +1,79 @@
+import os
+import sys
+from dataclasses import dataclass, replace
+from multiprocessing import Process
+
+sys.path.append(".")
+
+from scraping_forms.nested_dropdowns import DropDownSelection, NestedDropDowns
+from scraping_forms.scrape_election_forms import E14Cong2018
+
+
+def _run_worker(scraper: NestedDropDowns):
+    scraper.run()
+
+
+@dataclass
+class ParallelNestedDropDowns:
+    # splits the dropdown-tree at partition_level across num_workers browsers,
+    # every worker has its own download_path (chrome-downloads and state.json) but
+    # they share data_dir and one selection_states.jsonl; the politeness-budget
+    # max_pdfs_per_second is split evenly among the workers
+    scraper: NestedDropDowns
+    partition_level: str
+    num_workers: int = 4
+    max_pdfs_per_second: float = 2.0
+
+    def _worker_scraper(self, worker_index: int) -> NestedDropDowns:
+        assert self.partition_level in [s.name for s in self.scraper.selections]
+        return replace(
+            self.scraper,
+            download_path=f"{self.scraper.download_path}/worker-{worker_index}",
+            selections=[
+                replace(
+                    s,
+                    partition=(
+                        (worker_index, self.num_workers)
+                        if s.name == self.partition_level
+                        else None
+                    ),
+                )
+                for s in self.scraper.selections
+            ],
+            progress_jsonl=f"{self.scraper.download_path}/selection_states.jsonl",
+            min_seconds_between_pdfs=self.num_workers / self.max_pdfs_per_second,
+        )
+
+    def run(self):
+        os.makedirs(self.scraper.download_path, exist_ok=True)
+        workers = [
+            Process(target=_run_worker, args=(self._worker_scraper(k),))
+            for k in range(self.num_workers)
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+
+if __name__ == "__main__":
+    data_path = os.environ["DATA_PATH"]
+
+    scraper = E14Cong2018(
+        base_url="https://elecciones1.registraduria.gov.co",
+        url="https://elecciones1.registraduria.gov.co/e14_cong_2018/",
+        download_path=f"{data_path}/e14_cong_2018/downloads",
+        data_dir=f"{data_path}/e14_cong_2018/data",
+        selections=[
+            DropDownSelection("corporacion", '//*[@id="select_corp"]'),
+            DropDownSelection("departamento", '//*[@id="select_dep"]'),
+            DropDownSelection("municipio", '//*[@id="mpio"]'),
+            DropDownSelection("zona", '//*[@id="zona"]'),
+            DropDownSelection("puesto", '//*[@id="pto"]'),
+        ],
+        between_two_pdfs_wait_time=0.1,
+        headless=False,  # scraping does NOT work in headless mode (see readme)
+    )
+    ParallelNestedDropDowns(
+        scraper, partition_level="departamento", num_workers=4
+    ).run()
@@ -0,0 +1,5 @@
+def pdf_file_names(pdf_url: str, base_url: str) -> tuple[str, str]:
+    # file-name as served and the unique one under which it is stored in data_dir;
+    # shared by the selenium- and the http-scrapers, so it must not import selenium
+    pdf_file_full = pdf_url.replace(f"{base_url}/", "").replace("/", "_")
+    return pdf_url.split("/")[-1], pdf_file_full
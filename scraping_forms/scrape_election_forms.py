@@ -1,6 +1,9 @@
 from dataclasses import dataclass
+from typing import ClassVar
 
 from bs4 import BeautifulSoup
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
 from selenium_scraping.selenium_util import click_it
 
 from scraping_forms.nested_dropdowns import NestedDropDowns
@@ -10,7 +13,15 @@ from scraping_forms.nested_dropdowns import NestedDropDowns
 class ESCCong(NestedDropDowns):
     def get_pdf_urls(self):
         submit_button = "/html/body/div/div[2]/div[3]/div/div[1]/div/form/a"
+        probe = self._first_element(By.CLASS_NAME, "btnPdf")
         click_it(self.wd, submit_button)
+        self._wait_for_refresh("pdf-links-refresh", probe)
+        self.waiter.until(
+            self.wd,
+            "pdf-links",
+            EC.presence_of_all_elements_located((By.CLASS_NAME, "btnPdf")),
+            do_raise=False,  # there are leafs without pdfs
+        )
         # self.wd.save_screenshot(f"screenshot.png")
         soup = BeautifulSoup(self.wd.page_source, features="html.parser")
         pdfs = [
@@ -21,7 +32,18 @@ class ESCCong(NestedDropDowns):
 
 @dataclass
 class E14Cong2018(NestedDropDowns):
+    pdf_links_locator: ClassVar = (
+        By.XPATH,
+        '//a[not(starts-with(@href, "javascript"))]',
+    )
+
     def get_pdf_urls(self):
+        self.waiter.until(
+            self.wd,
+            "pdf-links",
+            EC.presence_of_all_elements_located(self.pdf_links_locator),
+            do_raise=False,  # there are leafs without pdfs
+        )
         soup = BeautifulSoup(self.wd.page_source, features="html.parser")
         pdfs = [
             f"{e.attrs['href']}"
@@ -1,17 +1,25 @@
 import os
+import traceback
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Union
+from urllib.parse import urljoin
 
 import requests
 from bs4 import BeautifulSoup
 from tqdm import tqdm
 
 from data_io.download_extract_files import wget_file
-from data_io.readwrite_files import write_lines, read_lines
+from data_io.readwrite_files import write_lines, read_lines, read_jsonl, write_jsonl
 from misc_utils.cached_data import CachedData, ContinuedCachedData
 from misc_utils.dataclass_utils import _UNDEFINED, UNDEFINED
-from misc_utils.utils import just_try
+
+
+def is_complete_pdf(file: str) -> bool:
+    # truncated downloads lack the trailing %%EOF-marker
+    with open(file, "rb") as f:
+        f.seek(max(0, os.path.getsize(file) - 1024))
+        return b"%%EOF" in f.read()
 
 
 @dataclass
@@ -21,16 +29,44 @@ class WgetPdfs(ContinuedCachedData):
 
     def continued_build_cache(self) -> None:
         pdf_dir = self.prefix_cache_dir("pdfs")
-
+        tmp_dir = self.prefix_cache_dir("pdfs_part")  # wget writes here first
+        os.makedirs(pdf_dir, exist_ok=True)
+        os.makedirs(tmp_dir, exist_ok=True)
         if not os.path.isfile(self.hrefs_file):
             self._write_hrefs_file()
-            os.makedirs(pdf_dir)
 
-        already_downloaded = list(Path(pdf_dir).glob("*.*"))
-        hrefs = [s for s in read_lines(self.hrefs_file) if s not in already_downloaded]
+        if not os.path.isfile(self.downloaded_jsonl):
+            # bootstrap from files that were downloaded before there was a manifest,
+            # truncated leftovers are not trusted
+            write_jsonl(
+                self.downloaded_jsonl,
+                [
+                    {"file": e.name}
+                    for e in os.scandir(pdf_dir)
+                    if is_complete_pdf(e.path)
+                ],
+            )
+        already_downloaded = {d["file"] for d in read_jsonl(self.downloaded_jsonl)}
+        hrefs = [
+            s
+            for s in read_lines(self.hrefs_file)
+            if Path(s).name not in already_downloaded
+        ]
         print(f"already got: {len(already_downloaded)}, {len(hrefs)} still TODO")
-        for pdf_file in tqdm(hrefs, desc="wgetting pdfs-files"):
-            just_try(lambda :wget_file(f"{url}/{pdf_file}", pdf_dir),verbose=True)
+        for href in tqdm(hrefs, desc="wgetting pdfs-files"):
+            name = Path(href).name
+            tmp_file = f"{tmp_dir}/{name}"
+            try:
+                wget_file(urljoin(self.url, href), tmp_dir)
+            except Exception:
+                traceback.print_exc()
+            if os.path.isfile(tmp_file) and is_complete_pdf(tmp_file):
+                os.replace(tmp_file, f"{pdf_dir}/{name}")
+                write_jsonl(self.downloaded_jsonl, [{"file": name}], mode="ab")
+            else:
+                print(f"incomplete download of {href}")
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
 
     def _write_hrefs_file(self):
         page = requests.get(self.url)
@@ -50,6 +86,11 @@ class WgetPdfs(ContinuedCachedData):
     def hrefs_file(self):
         return self.prefix_cache_dir(f"hrefs.txt")
 
+    @property
+    def downloaded_jsonl(self):
+        # manifest of completed downloads, next to hrefs.txt
+        return self.prefix_cache_dir("downloaded.jsonl")
+
 
 if __name__ == "__main__":
     url = "https://elecciones1.registraduria.gov.co/esc_cong_2018/archivos/divulgacion/"